@@ -1,18 +1,37 @@
 import asyncio
 import getopt
+import glob
+import gzip
 import hashlib
+import io
 import logging
+import mmap
+import os
 import re
+import ssl
 import sys
+import threading
 import time
+import zlib
+from bisect import bisect_left
 from collections import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import reduce
 from itertools import chain
-from json import loads, dumps
+from json import loads, dumps, JSONDecoder
+from urllib.parse import urlencode
 import aiohttp
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.connection import Connection
+from elasticsearch.connection.http_urllib3 import create_ssl_context
+from elasticsearch.exceptions import ConnectionError as EsConnectionError, ConnectionTimeout, ImproperlyConfigured, SSLError
 from elasticsearch_async import AsyncElasticsearch
+from elasticsearch_async.connection import AIOHttpConnection
+import requests
 from pysolr import Solr, SolrCoreAdmin
+from requests.adapters import HTTPAdapter
+from queue import Queue
 
 
 logging.basicConfig(format='%(asctime)s [%(name)s][%(process)d] %(levelname)s: %(message)s')
@@ -21,6 +40,27 @@ LOGGER.setLevel(logging.INFO)
 
 DEFAULT_ES_DOC_TYPE = '_doc'
 DEFAULT_ID_FIELD = 'id'
+DEFAULT_SINK_FILE_SIZE = 100 * 1024 * 1024
+JSON_CHUNK_SIZE = 1024 * 1024
+DEFAULT_FAN_OUT_BUFFER = 10
+DEFAULT_VERIFY_RANGES = 16
+DEFAULT_VERIFY_LEAF_SIZE = 10000
+DEFAULT_READERS = 4
+DEFAULT_TRANSLATORS = 2
+DEFAULT_WRITERS = 4
+PROGRESS_LOG_INTERVAL = 10
+DEFAULT_POOL_SIZE = 10
+DEFAULT_KEEPALIVE = 30
+DEFAULT_TIMEOUT = 60
+DEFAULT_PROFILE_INTERVAL = 0.01
+STAGE_SOLR_FETCH = 'solr_fetch'
+STAGE_JSON_DECODE = 'json_decode'
+STAGE_TRANSLATE = 'translate'
+STAGE_SERIALIZE = 'serialize'
+STAGE_BULK_WAIT = 'bulk_wait'
+STAGE_OTHER = 'other'
+PROFILE_STAGES = (STAGE_SOLR_FETCH, STAGE_JSON_DECODE, STAGE_TRANSLATE, STAGE_SERIALIZE, STAGE_BULK_WAIT, STAGE_OTHER)
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
 
 
 class IllegalStateError(RuntimeError):
@@ -47,39 +87,788 @@ class TranslationMap(object):
         return id_key
 
 
+class TransportStats(object):
+    """
+    Bytes sent and received by the solr and elasticsearch clients, with their logical
+    (uncompressed) size and their size on the wire.
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sent_logical = 0
+        self.sent_wire = 0
+        self.received_logical = 0
+        self.received_wire = 0
+
+    def add_sent(self, nb_logical, nb_wire):
+        with self.lock:
+            self.sent_logical += nb_logical
+            self.sent_wire += nb_wire
+
+    def add_received(self, nb_logical, nb_wire):
+        with self.lock:
+            self.received_logical += nb_logical
+            self.received_wire += nb_wire
+
+    def __str__(self) -> str:
+        return 'sent %s (%s on wire), received %s (%s on wire)' % (
+            _format_size(self.sent_logical), _format_size(self.sent_wire),
+            _format_size(self.received_logical), _format_size(self.received_wire))
+
+
+class StatsUrllib3HttpConnection(Urllib3HttpConnection):
+    """
+    Urllib3HttpConnection counting the request and response bodies before and after gzip compression
+    (http_compress for the requests, Accept-Encoding for the responses).
+    """
+    def __init__(self, *args, transport_stats=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.transport_stats = TransportStats() if transport_stats is None else transport_stats
+        self._pool_urlopen, self.pool.urlopen = self.pool.urlopen, self._urlopen
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        if body and not self.http_compress:
+            self.transport_stats.add_sent(len(body), len(body))
+        return super().perform_request(method, url, params, body, timeout, ignore, headers)
+
+    def _gzip_compress(self, body):
+        compressed = super()._gzip_compress(body)
+        self.transport_stats.add_sent(len(body), len(compressed))
+        return compressed
+
+    def _urlopen(self, *args, **kwargs):
+        """the response body is already read and decompressed by urllib3, tell() is its size on the wire"""
+        response = self._pool_urlopen(*args, **kwargs)
+        nb_logical = len(response.data)
+        self.transport_stats.add_received(nb_logical, response.tell() or nb_logical)
+        return response
+
+
+class StatsAIOHttpConnection(AIOHttpConnection):
+    """
+    AIOHttpConnection with a bounded keep-alive connection pool (maxsize, keepalive in seconds),
+    gzip request bodies (http_compress) and request and response bodies counted before and after compression.
+    """
+    def __init__(self, host='localhost', port=9200, http_auth=None, use_ssl=False, verify_certs=False, ca_certs=None,
+                 client_cert=None, client_key=None, ssl_context=None, use_dns_cache=True, loop=None,
+                 maxsize=DEFAULT_POOL_SIZE, keepalive=DEFAULT_KEEPALIVE, transport_stats=None, **kwargs) -> None:
+        # AIOHttpConnection.__init__ would create an unbounded session ignoring the connection headers
+        Connection.__init__(self, host=host, port=port, use_ssl=use_ssl or ssl_context is not None, **kwargs)
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.transport_stats = TransportStats() if transport_stats is None else transport_stats
+        if isinstance(http_auth, str):
+            http_auth = tuple(http_auth.split(':', 1))
+        if ssl_context is not None and (verify_certs or ca_certs or client_cert):
+            raise ImproperlyConfigured('When using `ssl_context`, `verify_certs`, `ca_certs` and `client_cert` are not permitted')
+        if self.use_ssl and ssl_context is None:
+            ssl_context = create_ssl_context(cafile=ca_certs)
+            if client_cert is not None:
+                ssl_context.load_cert_chain(client_cert, client_key)
+            if not verify_certs:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+        self.session = aiohttp.ClientSession(
+            auth=None if http_auth is None else aiohttp.BasicAuth(*http_auth),
+            connector=aiohttp.TCPConnector(loop=self.loop, limit=maxsize, keepalive_timeout=keepalive,
+                                           use_dns_cache=use_dns_cache, ssl_context=ssl_context),
+            headers=dict(self.headers, **{'content-type': 'application/json'}), auto_decompress=False)
+        self.base_url = self.host + self.url_prefix
+
+    async def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        """AIOHttpConnection.perform_request reading the responses before their decompression to count them"""
+        if body:
+            nb_logical = len(body)
+            if self.http_compress:
+                body = self._gzip_compress(body)
+                headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+            self.transport_stats.add_sent(nb_logical, len(body))
+        url_path = url if not params else '%s?%s' % (url, urlencode(params))
+        url = self.base_url + url_path
+        start = self.loop.time()
+        try:
+            async with self.session.request(method, url, data=body, headers=headers,
+                                            timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as response:
+                raw_body = await response.read()
+            duration = self.loop.time() - start
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log_request_fail(method, url, url_path, body, self.loop.time() - start, exception=e)
+            if isinstance(e, (aiohttp.ServerFingerprintMismatch, aiohttp.ClientSSLError)):
+                raise SSLError('N/A', str(e), e)
+            if isinstance(e, asyncio.TimeoutError):
+                raise ConnectionTimeout('TIMEOUT', str(e), e)
+            raise EsConnectionError('N/A', str(e), e)
+
+        decompressed = _decompress(raw_body, response.headers.get('Content-Encoding'))
+        self.transport_stats.add_received(len(decompressed), len(raw_body))
+        raw_data = decompressed.decode('utf-8', 'surrogatepass')
+        if not (200 <= response.status < 300) and response.status not in ignore:
+            self.log_request_fail(method, url, url_path, body, duration, status_code=response.status, response=raw_data)
+            self._raise_error(response.status, raw_data)
+        self.log_request_success(method, url, url_path, body, response.status, raw_data, duration)
+        return response.status, response.headers, raw_data
+
+
+class ConnectionSettings(object):
+    """
+    Creates the solr and elasticsearch clients with connection pools of pool_size keep-alive connections,
+    gzip compressed elasticsearch requests (compress) and the count of their traffic in stats.
+    Responses compression is negotiated with Accept-Encoding by requests and aiohttp.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keepalive=DEFAULT_KEEPALIVE, timeout=DEFAULT_TIMEOUT,
+                 compress=False) -> None:
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.compress = compress
+        self.stats = TransportStats()
+        self.solr_session = None
+
+    def es(self, eshost) -> Elasticsearch:
+        """eshost is an url or a host dict, like the ones of the shard routing node clients"""
+        return Elasticsearch(hosts=[eshost], connection_class=StatsUrllib3HttpConnection, maxsize=self.pool_size,
+                             timeout=self.timeout, http_compress=self.compress, transport_stats=self.stats)
+
+    def aes(self, eshost) -> AsyncElasticsearch:
+        return AsyncElasticsearch(hosts=[eshost], connection_class=StatsAIOHttpConnection, maxsize=self.pool_size,
+                                  keepalive=self.keepalive, timeout=self.timeout, http_compress=self.compress,
+                                  transport_stats=self.stats)
+
+    def solr(self, solr_url) -> Solr:
+        """the solr clients share one requests session"""
+        if self.solr_session is None:
+            self.solr_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self.solr_session.mount('http://', adapter)
+            self.solr_session.mount('https://', adapter)
+            self.solr_session.hooks['response'].append(self._count_response)
+        solr = Solr(solr_url, always_commit=True, timeout=self.timeout)
+        solr.session = self.solr_session
+        return solr
+
+    def aiohttp_session(self) -> aiohttp.ClientSession:
+        """session for Solr2EsAsync, that decompresses the responses itself to count their size on the wire"""
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive),
+            timeout=aiohttp.ClientTimeout(total=self.timeout), auto_decompress=False)
+
+    def _count_response(self, response, *args, **kwargs):
+        nb_logical = len(response.content)
+        self.stats.add_received(nb_logical, response.raw.tell() or nb_logical)
+
+
+def _decompress(body, content_encoding) -> bytes:
+    """decompresses the JSON bodies read from aiohttp sessions created with auto_decompress=False"""
+    if content_encoding not in ('gzip', 'deflate') or body.lstrip()[:1] in (b'{', b'['):
+        return body
+    if content_encoding == 'gzip':
+        return gzip.decompress(body)
+    try:
+        return zlib.decompress(body)
+    except zlib.error:
+        return zlib.decompress(body, -zlib.MAX_WBITS)
+
+
+class ShardRouter(object):
+    """
+    Computes the primary shard of each action like elasticsearch does
+    (murmur3 of _routing or _id, see OperationRouting) so that bulks can be
+    sent directly to the node holding the primary instead of a coordinating node.
+    """
+    def __init__(self, number_of_shards, routing_num_shards, primary_nodes, clients) -> None:
+        self.number_of_shards = number_of_shards
+        self.routing_num_shards = routing_num_shards
+        self.routing_factor = routing_num_shards // number_of_shards
+        self.primary_nodes = primary_nodes
+        self.clients = clients
+
+    @classmethod
+    def from_cluster_state(cls, index_name, cluster_state, nodes_info, client_factory, base_host=None):
+        """
+        :param client_factory: creates the client of a node from its host dict, that is base_host (scheme,
+        credentials, TLS...) with the host and port of the node http publish address
+        """
+        index_metadata = cluster_state['metadata']['indices'][index_name]
+        number_of_shards = int(index_metadata['settings']['index']['number_of_shards'])
+        routing_num_shards = int(index_metadata.get('routing_num_shards', number_of_shards))
+        primary_nodes = dict()
+        for shard, copies in cluster_state['routing_table']['indices'][index_name]['shards'].items():
+            primaries = [c['node'] for c in copies if c['primary'] and c['state'] == 'STARTED']
+            if len(primaries) == 0:
+                raise IllegalStateError('no started primary for shard %s of index %s' % (shard, index_name))
+            primary_nodes[int(shard)] = primaries[0]
+        clients = {node: client_factory(_node_host(nodes_info['nodes'][node], base_host))
+                   for node in set(primary_nodes.values())}
+        return cls(number_of_shards, routing_num_shards, primary_nodes, clients)
+
+    @classmethod
+    def from_es(cls, es, index_name, client_factory=None):
+        cluster_state = es.cluster.state(metric='metadata,routing_table', index=index_name)
+        return cls.from_cluster_state(index_name, cluster_state, es.nodes.info(metric='http'),
+                                      _client_factory_of(es) if client_factory is None else client_factory,
+                                      es.transport.hosts[0])
+
+    @classmethod
+    async def from_aes(cls, aes, index_name, client_factory=None):
+        cluster_state = await aes.cluster.state(metric='metadata,routing_table', index=index_name)
+        return cls.from_cluster_state(index_name, cluster_state, await aes.nodes.info(metric='http'),
+                                      _client_factory_of(aes) if client_factory is None else client_factory,
+                                      aes.transport.hosts[0])
+
+    def shard_for(self, es_action) -> int:
+        index_params = es_action['index']
+        routing = index_params.get('_routing', index_params['_id'])
+        return (murmur3_es_hash(str(routing)) % self.routing_num_shards) // self.routing_factor
+
+    def group_actions(self, actions_as_list) -> dict:
+        actions_per_node = dict()
+        for action, doc in actions_as_list:
+            node = self.primary_nodes[self.shard_for(action)]
+            actions_per_node.setdefault(node, []).append((action, doc))
+        return actions_per_node
+
+    def close(self):
+        for client in self.clients.values():
+            client.transport.close()
+
+
+def murmur3_es_hash(routing) -> int:
+    """
+    murmur3 x86 32 bits with seed 0 over the UTF-16 LE chars of routing,
+    returned as a signed java int like Murmur3HashFunction.hash(String)
+    """
+    data = routing.encode('utf-16-le')
+    c1, c2, h = 0xcc9e2d51, 0x1b873593, 0
+    nb_blocks = len(data) // 4
+    for i in range(0, nb_blocks * 4, 4):
+        k = int.from_bytes(data[i:i + 4], 'little')
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    tail = data[nb_blocks * 4:]
+    if len(tail) > 0:
+        k = int.from_bytes(tail, 'little')
+        k = (k * c1) & 0xffffffff
+        k = ((k << 15) | (k >> 17)) & 0xffffffff
+        k = (k * c2) & 0xffffffff
+        h ^= k
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h - 0x100000000 if h & 0x80000000 else h
+
+
+def _node_host(node_info, base_host=None) -> dict:
+    # publish_address can be 'hostname/ip:port' or '[ipv6]:port'
+    host, port = node_info['http']['publish_address'].split('/')[-1].rsplit(':', 1)
+    return dict(base_host or {}, host=host.strip('[]'), port=int(port))
+
+
+def _client_factory_of(client):
+    """creates clients of the same class, connection class and settings than client"""
+    return lambda host: type(client)(hosts=[host], connection_class=client.transport.connection_class,
+                                     **client.transport.kwargs)
+
+
+class JsonFileSource(object):
+    """
+    Reads solr docs from export files instead of solr : JSON files (select response or array of docs)
+    or JSON lines files (.jsonl/.ndjson), gzipped if they end with .gz. The docs are streamed one by one,
+    uncompressed JSON lines files are memory mapped.
+    """
+    def __init__(self, paths) -> None:
+        self.paths = paths
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        return cls([path for pattern in patterns.split(',') for path in sorted(glob.glob(pattern))])
+
+    def produce_results(self, solr_rows_pagination=10, **_):
+        nb_results = 0
+        page = []
+        for doc in self.read_docs():
+            page.append(doc)
+            if len(page) == solr_rows_pagination:
+                nb_results += len(page)
+                if nb_results % 10000 == 0:
+                    LOGGER.info('read %s docs', nb_results)
+                yield page
+                page = []
+        if len(page) > 0:
+            yield page
+
+    def read_docs(self):
+        for path in self.paths:
+            LOGGER.info('reading %s', path)
+            name = path[:-3] if path.endswith('.gz') else path
+            json_lines = name.endswith('.jsonl') or name.endswith('.ndjson')
+            if path.endswith('.gz'):
+                with gzip.open(path, 'rb') as export:
+                    yield from _read_json_lines(export) if json_lines else _read_json(export)
+            elif json_lines:
+                if os.path.getsize(path) == 0:
+                    continue
+                with open(path, 'rb') as export, mmap.mmap(export.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    yield from _read_json_lines(iter(mapped.readline, b''))
+            else:
+                with open(path, 'rb') as export:
+                    yield from _read_json(export)
+
+
+def _read_json_lines(lines):
+    for line in lines:
+        if line.strip():
+            yield loads(line)
+
+
+def _read_json(export, chunk_size=JSON_CHUNK_SIZE):
+    """streams the docs of a select response {"response": {"docs": [...]}} or of an array of docs"""
+    stream = _JsonStream(io.TextIOWrapper(export, encoding='utf-8'), chunk_size)
+    if stream.next_char() == '{':
+        stream.find_key('response')
+        if stream.next_char() != '{':
+            raise ValueError('response of JSON export is not an object')
+        stream.find_key('docs')
+    else:
+        stream.pos -= 1
+    yield from stream.array_values()
+
+
+class _JsonStream(object):
+    """
+    Incremental reader of a JSON text, read by chunks : the values are decoded one by one with
+    JSONDecoder.raw_decode so that only the current value and a chunk are held in memory.
+    """
+    def __init__(self, text, chunk_size) -> None:
+        self.text = text
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = JSONDecoder()
+
+    def _fill(self) -> bool:
+        chunk = '' if self.eof else self.text.read(self.chunk_size)
+        self.eof = len(chunk) == 0
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return not self.eof
+
+    def next_char(self) -> str:
+        """consumes and returns the next char that is not a whitespace"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                self.pos += 1
+                return self.buffer[self.pos - 1]
+            if not self._fill():
+                raise ValueError('unexpected end of JSON export')
+
+    def value(self):
+        self.next_char()
+        self.pos -= 1
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:  # a number can be cut at the end of the buffer
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def find_key(self, key):
+        """consumes the members of the current object until the value of key"""
+        while True:
+            if self.value() == key:
+                if self.next_char() != ':':
+                    raise ValueError('expected : after %s in JSON export' % key)
+                return
+            self.next_char()
+            self.value()
+            if self.next_char() != ',':
+                raise ValueError('no %s in JSON export' % key)
+
+    def array_values(self):
+        if self.next_char() != '[':
+            raise ValueError('expected an array of docs in JSON export')
+        if self.next_char() == ']':
+            return
+        self.pos -= 1
+        while True:
+            yield self.value()
+            char = self.next_char()
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError('expected , or ] between docs in JSON export')
+
+
+class BulkFileSink(object):
+    """
+    Writes es actions as _bulk NDJSON files <prefix>-00000.ndjson, <prefix>-00001.ndjson... of at most
+    max_bytes each (unless a single document is bigger), to be loaded later with any bulk loader.
+    """
+    def __init__(self, prefix, max_bytes=DEFAULT_SINK_FILE_SIZE) -> None:
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.file = None
+        self.file_size = 0
+        self.nb_files = 0
+
+    def write(self, actions_as_list):
+        for action, doc in actions_as_list:
+            lines = ('%s\n%s\n' % (dumps(action), dumps(doc))).encode('utf-8')
+            if self.file is None or (self.file_size > 0 and self.file_size + len(lines) > self.max_bytes):
+                self._rotate()
+            self.file.write(lines)
+            self.file_size += len(lines)
+
+    def _rotate(self):
+        self.close()
+        self.file = open('%s-%05d.ndjson' % (self.prefix, self.nb_files), 'wb')
+        self.file_size = 0
+        self.nb_files += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class MemoryBudget(object):
+    """
+    Accounts the bytes held in the pipeline for each page, from the moment it is read until its bulk is
+    acknowledged : the CPython size of the solr docs (acquire), of the translated dicts (_actions_size) and of the
+    serialized bulk bodies (add). Readers wait for the usage to go under max_bytes (no limit if None) before
+    reading the next page, so the usage can exceed max_bytes by one page per reader.
+    """
+    def __init__(self, max_bytes=None) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, solr_results) -> int:
+        return self.add(_docs_size(solr_results))
+
+    def add(self, nb_bytes) -> int:
+        with self.condition:
+            self.used += nb_bytes
+        return nb_bytes
+
+    def release(self, nb_bytes):
+        with self.condition:
+            self.used -= nb_bytes
+            self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.is_exhausted():
+                self.condition.wait()
+
+    def is_exhausted(self) -> bool:
+        return self.max_bytes is not None and self.used >= self.max_bytes
+
+    def __str__(self) -> str:
+        return _format_size(self.used) if self.max_bytes is None else \
+            '%s of %s' % (_format_size(self.used), _format_size(self.max_bytes))
+
+
+class AsyncMemoryBudget(MemoryBudget):
+    """
+    MemoryBudget for asyncio, to be used from the event loop thread.
+    """
+    def __init__(self, max_bytes=None) -> None:
+        super().__init__(max_bytes)
+        self.available = asyncio.Event()
+        self.available.set()
+
+    def release(self, nb_bytes):
+        super().release(nb_bytes)
+        if not self.is_exhausted():
+            self.available.set()
+
+    async def wait(self):
+        while self.is_exhausted():
+            self.available.clear()
+            await self.available.wait()
+
+
+def _docs_size(docs) -> int:
+    """
+    CPython size in bytes of solr docs : sys.getsizeof of the dicts and of their values. The keys are
+    not counted as the JSON decoder shares them between the docs of a page.
+    """
+    def value_size(value):
+        if isinstance(value, list):
+            return sys.getsizeof(value) + sum(value_size(v) for v in value)
+        return sys.getsizeof(value)
+    return sum(sys.getsizeof(doc) + sum(value_size(v) for v in doc.values()) for doc in docs)
+
+
+def _actions_size(actions_as_list) -> int:
+    """CPython size in bytes of the translated dicts, without their values that are the ones of the solr docs"""
+    return sum(sys.getsizeof(action) + sys.getsizeof(action['index']) + sys.getsizeof(doc) for action, doc in actions_as_list)
+
+
+def _format_size(nb_bytes) -> str:
+    for unit in ('T', 'G', 'M', 'K'):
+        if nb_bytes >= SIZE_UNITS[unit]:
+            return '%.1f%s' % (nb_bytes / SIZE_UNITS[unit], unit)
+    return '%dB' % nb_bytes
+
+
+class EsTarget(object):
+    """
+    One of the elasticsearch indices a solr core is fanned out to, with its own
+    client, mapping and translation map.
+    """
+    def __init__(self, es, index_name, mapping=None, translation_map=TranslationMap()) -> None:
+        self.es = es
+        self.index_name = index_name
+        self.mapping = mapping
+        self.translation_map = translation_map
+
+
+class SamplingProfiler(object):
+    """
+    Samples every interval seconds, from a background thread, the stacks of the threads that are in a stage
+    (sys._current_frames). Each sample is tagged with the stage of its thread and weighted with the time elapsed
+    since the previous one. The samples of solr_fetch spent in the json module are tagged json_decode, as pysolr
+    decodes the response inside its search.
+    stop() writes into output_dir the collapsed stacks of each stage (<stage>.collapsed), of all the stages
+    (all.collapsed, rooted by the stage name) for flamegraph.pl or speedscope, and the time summary of the stages.
+    The thread calling start() is sampled as other out of its stages, the other threads only in their stages.
+    Without output_dir nothing is sampled and the stages are only tagged.
+    """
+    def __init__(self, output_dir=None, interval=DEFAULT_PROFILE_INTERVAL) -> None:
+        self.output_dir = output_dir
+        self.interval = interval
+        self.thread_stages = dict()
+        self.samples = dict()
+        self.stage_seconds = dict()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    @contextmanager
+    def stage(self, name):
+        """tags the current thread with the stage name, the thread is not sampled out of its stages"""
+        ident = threading.get_ident()
+        previous = self.thread_stages.get(ident)
+        self.thread_stages[ident] = name
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.thread_stages[ident]
+            else:
+                self.thread_stages[ident] = previous
+
+    def start(self):
+        if self.output_dir is None or self.sampler is not None:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.thread_stages[threading.get_ident()] = STAGE_OTHER
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._run, name='solr2es-profiler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        if self.sampler is None:
+            return
+        self.stopped.set()
+        self.sampler.join()
+        self.sampler = None
+        self.thread_stages.pop(threading.get_ident(), None)
+        self.write()
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            now = time.perf_counter()
+            self.sample(now - last)
+            last = now
+
+    def sample(self, elapsed):
+        frames = sys._current_frames()
+        for ident, stage in dict(self.thread_stages).items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = _frame_names(frame)
+            if stage == STAGE_SOLR_FETCH and any(name.startswith('json.') for name in stack):
+                stage = STAGE_JSON_DECODE
+            key = (stage, ';'.join(stack))
+            self.samples[key] = self.samples.get(key, 0) + 1
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + elapsed
+
+    def write(self):
+        stacks_by_stage = dict()
+        for (stage, stack), nb_samples in sorted(self.samples.items()):
+            stacks_by_stage.setdefault(stage, []).append((stack, nb_samples))
+        with open(os.path.join(self.output_dir, 'all.collapsed'), 'w') as all_file:
+            for stage, stacks in stacks_by_stage.items():
+                with open(os.path.join(self.output_dir, '%s.collapsed' % stage), 'w') as stage_file:
+                    for stack, nb_samples in stacks:
+                        stage_file.write('%s %d\n' % (stack, nb_samples))
+                        all_file.write('%s;%s %d\n' % (stage, stack, nb_samples))
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, 'summary.txt'), 'w') as summary_file:
+            summary_file.write(summary)
+        LOGGER.info('profile written into %s\n%s', self.output_dir, summary)
+
+    def summary(self) -> str:
+        total = sum(self.stage_seconds.values())
+        nb_samples = dict()
+        for (stage, _), nb in self.samples.items():
+            nb_samples[stage] = nb_samples.get(stage, 0) + nb
+        lines = ['%-12s %10s %7s %8s' % ('stage', 'seconds', '%', 'samples')]
+        for stage in PROFILE_STAGES:
+            seconds = self.stage_seconds.get(stage, 0)
+            lines.append('%-12s %10.2f %7.2f %8d' % (stage, seconds, _percent(seconds, total), nb_samples.get(stage, 0)))
+        return '\n'.join(lines) + '\n'
+
+
+def _frame_names(frame) -> list:
+    """the module.function names of a stack, from the outermost frame"""
+    names = []
+    while frame is not None:
+        names.append('%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
 class Solr2Es(object):
-    def __init__(self, solr, es, refresh=False) -> None:
+    def __init__(self, solr, es, refresh=False, shard_routing=False, source=None, sink=None, memory_budget=None,
+                 profiler=None, client_factory=None) -> None:
         super().__init__()
         self.solr = solr
         self.es = es
         self.refresh = refresh
+        self.shard_routing = shard_routing
+        self.source = self if source is None else source
+        self.sink = sink
+        self.memory_budget = MemoryBudget() if memory_budget is None else memory_budget
+        self.profiler = SamplingProfiler() if profiler is None else profiler
+        self.client_factory = client_factory
 
     def migrate(self, index_name, mapping=None, translation_map=TranslationMap(), solr_filter_query='*',
                 sort_field=DEFAULT_ID_FIELD, solr_rows=500, solr_fields='*', exclude_solr_id=False) -> int:
         nb_results = 0
-        if not self.es.indices.exists([index_name]):
+        if self.sink is None and not self.es.indices.exists([index_name]):
             self.es.indices.create(index_name, body=mapping)
-        for results in self.produce_results(solr_filter_query=solr_filter_query,
-                                            sort_field=sort_field, solr_rows_pagination=solr_rows, solr_field_list = solr_fields):
-            actions_as_list = create_es_actions(index_name, results, translation_map, exclude_solr_id)
-            actions = '\n'.join(list(map(lambda d: dumps(d), chain(*actions_as_list))))
-            response = self.es.bulk(actions, index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
-            nb_results += len(results)
-            if response['errors']:
-                for err in response['items']:
-                    LOGGER.warning(err)
-                nb_results -= len(response['items'])
-                LOGGER.error(response['errors'])
+        router = ShardRouter.from_es(self.es, index_name, self.client_factory) if self.shard_routing and self.sink is None else None
+        node_executor = None if router is None else ThreadPoolExecutor(max_workers=len(router.clients))
+        self.profiler.start()
+        try:
+            for results in self.source.produce_results(solr_filter_query=solr_filter_query,
+                                                       sort_field=sort_field, solr_rows_pagination=solr_rows, solr_field_list = solr_fields):
+                nb_bytes = self.memory_budget.acquire(results)
+                with self.profiler.stage(STAGE_TRANSLATE):
+                    actions_as_list = create_es_actions(index_name, results, translation_map, exclude_solr_id)
+                nb_bytes += self.memory_budget.add(_actions_size(actions_as_list))
+                nb_results += len(results)
+                if self.sink is not None:
+                    with self.profiler.stage(STAGE_SERIALIZE):
+                        self.sink.write(actions_as_list)
+                    self.memory_budget.release(nb_bytes)
+                    continue
+                if router is None:
+                    responses = [self._bulk(self.es, index_name, actions_as_list)]
+                else:
+                    responses = list(node_executor.map(lambda item: self._bulk(router.clients[item[0]], index_name, item[1]),
+                                                       router.group_actions(actions_as_list).items()))
+                for response in responses:
+                    if response['errors']:
+                        for err in response['items']:
+                            LOGGER.warning(err)
+                        nb_results -= len(response['items'])
+                        LOGGER.error(response['errors'])
+                self.memory_budget.release(nb_bytes)
+        finally:
+            if router is not None:
+                node_executor.shutdown()
+                router.close()
+            self.profiler.stop()
         LOGGER.info('processed %s documents', nb_results)
         return nb_results
 
+    def _bulk(self, es, index_name, actions_as_list) -> dict:
+        with self.profiler.stage(STAGE_SERIALIZE):
+            actions = '\n'.join(list(map(lambda d: dumps(d), chain(*actions_as_list))))
+        nb_bytes = self.memory_budget.add(sys.getsizeof(actions))
+        try:
+            with self.profiler.stage(STAGE_BULK_WAIT):
+                return es.bulk(actions, index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
+        finally:
+            self.memory_budget.release(nb_bytes)
+
+    def migrate_to_targets(self, targets, solr_filter_query='*', sort_field=DEFAULT_ID_FIELD, solr_rows=500,
+                           solr_fields='*', exclude_solr_id=False, buffer_size=DEFAULT_FAN_OUT_BUFFER) -> list:
+        """
+        Reads solr once and writes each page to every target from its own thread. Each target buffers at most
+        buffer_size pages so a slow target only blocks the reader when its buffer is full.
+        :return: the number of documents processed for each target
+        """
+        for target in targets:
+            if not target.es.indices.exists([target.index_name]):
+                target.es.indices.create(target.index_name, body=target.mapping)
+        queues = [Queue(maxsize=buffer_size) for _ in targets]
+        nb_results = [0] * len(targets)
+        errors = [None] * len(targets)
+        writers = [threading.Thread(target=self._write_target, args=(targets, queues, nb_results, errors, i), daemon=True)
+                   for i in range(len(targets))]
+        for writer in writers:
+            writer.start()
+        try:
+            for results in self.source.produce_results(solr_filter_query=solr_filter_query,
+                                                       sort_field=sort_field, solr_rows_pagination=solr_rows, solr_field_list=solr_fields):
+                for queue, body in zip(queues, create_fan_out_bulks(results, targets, exclude_solr_id)):
+                    queue.put((len(results), body, self.memory_budget.add(sys.getsizeof(body))))
+                self.memory_budget.wait()
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for writer in writers:
+                writer.join()
+        for target, nb, error in zip(targets, nb_results, errors):
+            LOGGER.info('processed %s documents for index %s', nb, target.index_name)
+            if error is not None:
+                raise error
+        return nb_results
+
+    def _write_target(self, targets, queues, nb_results, errors, i):
+        target = targets[i]
+        for nb_docs, body, nb_bytes in iter(queues[i].get, None):
+            if errors[i] is not None:
+                self.memory_budget.release(nb_bytes)
+                continue  # keeps draining so that the reader is never blocked by a failed target
+            try:
+                response = target.es.bulk(body, target.index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
+                nb_results[i] += nb_docs - _nb_bulk_errors(response)
+            except Exception as e:
+                LOGGER.exception('bulk to index %s failed', target.index_name)
+                errors[i] = e
+            finally:
+                self.memory_budget.release(nb_bytes)
+
     def produce_results(self, solr_filter_query='*', sort_field=DEFAULT_ID_FIELD, solr_rows_pagination=10, solr_field_list = '*'):
         nb_results = 0
         nb_total = 0
         cursor_ended = False
         kwargs = dict(fq=solr_filter_query, cursorMark='*', fl=solr_field_list, sort='%s asc' % sort_field, rows=solr_rows_pagination)
         while not cursor_ended:
-            results = self.solr.search('*:*', **kwargs)
+            with self.profiler.stage(STAGE_SOLR_FETCH):
+                results = self.solr.search('*:*', **kwargs)
             if kwargs['cursorMark'] == '*':
                 nb_total = results.hits
                 LOGGER.info('found %s documents', nb_total)
@@ -87,43 +876,132 @@ class Solr2Es(object):
                 kwargs['cursorMark'] = results.nextCursorMark
                 nb_results += len(results)
                 if nb_results % 10000 == 0:
-                    LOGGER.info('read %s docs of %s (%.2f %% done)', nb_results, nb_total, (100 * nb_results)/nb_total)
+                    LOGGER.info('read %s docs of %s (%.2f %% done, memory used %s)', nb_results, nb_total,
+                                (100 * nb_results)/nb_total, self.memory_budget)
                 yield results
             else:
                 cursor_ended = True
             time.sleep(1/100)
 
 class Solr2EsAsync(object):
-    def __init__(self, aiohttp_session, aes, solr_url, refresh=False) -> None:
+    def __init__(self, aiohttp_session, aes, solr_url, refresh=False, shard_routing=False, memory_budget=None,
+                 transport_stats=None, profiler=None, client_factory=None) -> None:
         super().__init__()
         self.solr_url = solr_url
         self.aiohttp_session = aiohttp_session
         self.aes = aes
         self.refresh = refresh
+        self.shard_routing = shard_routing
+        self.memory_budget = AsyncMemoryBudget() if memory_budget is None else memory_budget
+        self.transport_stats = TransportStats() if transport_stats is None else transport_stats
+        self.profiler = SamplingProfiler() if profiler is None else profiler
+        self.client_factory = client_factory
 
     async def migrate(self, index_name, es_index_body_str=None, translation_map=TranslationMap(), solr_filter_query=None, sort_field=DEFAULT_ID_FIELD, solr_rows_pagination=10, solr_fields='*', exclude_solr_id=False) -> int:
         if not await self.aes.indices.exists([index_name]):
             await self.aes.indices.create(index_name, body=es_index_body_str)
+        router = await ShardRouter.from_aes(self.aes, index_name, self.client_factory) if self.shard_routing else None
         nb_results = 0
-        async for results in self.produce_results(solr_filter_query=solr_filter_query,
-                                                  sort_field=sort_field,
-                                                  solr_rows_pagination=solr_rows_pagination,
-                                                  solr_field_list=solr_fields):
-            actions_as_list = create_es_actions(index_name, results, translation_map, exclude_solr_id)
-            actions = '\n'.join(list(map(lambda d: dumps(d), chain(*actions_as_list))))
-            try:
-                response = self.aes.bulk(actions, index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
+        pending_bulks = set()
+        self.profiler.start()
+        try:
+            async for results in self.produce_results(solr_filter_query=solr_filter_query,
+                                                      sort_field=sort_field,
+                                                      solr_rows_pagination=solr_rows_pagination,
+                                                      solr_field_list=solr_fields):
+                nb_bytes = self.memory_budget.acquire(results)
+                with self.profiler.stage(STAGE_TRANSLATE):
+                    actions_as_list = create_es_actions(index_name, results, translation_map, exclude_solr_id)
+                nb_bytes += self.memory_budget.add(_actions_size(actions_as_list))
+                bulks = {None: actions_as_list} if router is None else router.group_actions(actions_as_list)
+                page_bulks = []
+                for node, node_actions in bulks.items():
+                    aes = self.aes if node is None else router.clients[node]
+                    with self.profiler.stage(STAGE_SERIALIZE):
+                        actions = '\n'.join(list(map(lambda d: dumps(d), chain(*node_actions))))
+                    nb_bytes += self.memory_budget.add(sys.getsizeof(actions))
+                    try:
+                        page_bulks.append(asyncio.ensure_future(aes.bulk(actions, index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)))
+                    except:
+                        LOGGER.error(actions[0])
+                page_done = asyncio.gather(*page_bulks, return_exceptions=True)
+                page_done.add_done_callback(lambda done, nb=nb_bytes: self._page_acknowledged(done, nb))
+                pending_bulks.add(page_done)
+                page_done.add_done_callback(pending_bulks.discard)
                 nb_results += len(results)
-            except:
-                LOGGER.error(actions[0])
-
-            # nb_results += len(results)
-            # if response['errors']:
-            #     for err in response['items']:
-            #         LOGGER.warning(err)
-            #     nb_results -= len(response['items'])
+                with self.profiler.stage(STAGE_BULK_WAIT):
+                    await self.memory_budget.wait()
+
+                # nb_results += len(results)
+                # if response['errors']:
+                #     for err in response['items']:
+                #         LOGGER.warning(err)
+                #     nb_results -= len(response['items'])
+            with self.profiler.stage(STAGE_BULK_WAIT):
+                await asyncio.gather(*pending_bulks)
+        finally:
+            self.profiler.stop()
+            if router is not None:
+                await asyncio.gather(*(client.transport.close() for client in router.clients.values()))
         return nb_results
 
+    def _page_acknowledged(self, page_done, nb_bytes):
+        self.memory_budget.release(nb_bytes)
+        for result in page_done.result():
+            if isinstance(result, Exception):
+                LOGGER.error('bulk failed : %s', result)
+
+    async def migrate_to_targets(self, targets, solr_filter_query=None, sort_field=DEFAULT_ID_FIELD, solr_rows_pagination=10,
+                                 solr_fields='*', exclude_solr_id=False, buffer_size=DEFAULT_FAN_OUT_BUFFER) -> list:
+        """
+        Reads solr once and writes each page to every target from its own task. Each target buffers at most
+        buffer_size pages so a slow target only blocks the reader when its buffer is full.
+        :return: the number of documents processed for each target
+        """
+        for target in targets:
+            if not await target.es.indices.exists([target.index_name]):
+                await target.es.indices.create(target.index_name, body=target.mapping)
+        queues = [asyncio.Queue(maxsize=buffer_size) for _ in targets]
+        nb_results = [0] * len(targets)
+        errors = [None] * len(targets)
+        writers = [asyncio.ensure_future(self._write_target(targets, queues, nb_results, errors, i)) for i in range(len(targets))]
+        try:
+            async for results in self.produce_results(solr_filter_query=solr_filter_query,
+                                                      sort_field=sort_field,
+                                                      solr_rows_pagination=solr_rows_pagination,
+                                                      solr_field_list=solr_fields):
+                for queue, body in zip(queues, create_fan_out_bulks(results, targets, exclude_solr_id)):
+                    await queue.put((len(results), body, self.memory_budget.add(sys.getsizeof(body))))
+                await self.memory_budget.wait()
+        finally:
+            for queue in queues:
+                await queue.put(None)
+            await asyncio.gather(*writers)
+        for target, nb, error in zip(targets, nb_results, errors):
+            LOGGER.info('processed %s documents for index %s', nb, target.index_name)
+            if error is not None:
+                raise error
+        return nb_results
+
+    async def _write_target(self, targets, queues, nb_results, errors, i):
+        target = targets[i]
+        while True:
+            item = await queues[i].get()
+            if item is None:
+                break
+            nb_docs, body, nb_bytes = item
+            if errors[i] is not None:
+                self.memory_budget.release(nb_bytes)
+                continue  # keeps draining so that the reader is never blocked by a failed target
+            try:
+                response = await target.es.bulk(body, target.index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
+                nb_results[i] += nb_docs - _nb_bulk_errors(response)
+            except Exception as e:
+                LOGGER.exception('bulk to index %s failed', target.index_name)
+                errors[i] = e
+            finally:
+                self.memory_budget.release(nb_bytes)
+
     async def produce_results(self, solr_filter_query='*', sort_field=DEFAULT_ID_FIELD, solr_rows_pagination=10, solr_field_list='*'):
         cursor_ended = False
         nb_results = 0
@@ -131,22 +1009,404 @@ class Solr2EsAsync(object):
         kwargs = dict(cursorMark='*', sort='%s asc' % sort_field, q='*:*', wt='json',
                       fq=solr_filter_query, fl=solr_field_list, rows=solr_rows_pagination)
         while not cursor_ended:
-            async with self.aiohttp_session.get(self.solr_url + '/select/', params=kwargs) as resp:
-                json = loads(await resp.text())
-                if kwargs['cursorMark'] == '*':
-                    nb_total = int(json['response']['numFound'])
-                    LOGGER.info('found %s documents', json['response']['numFound'])
-                if kwargs['cursorMark'] != json['nextCursorMark']:
-                    kwargs['cursorMark'] = json['nextCursorMark']
-                    nb_results += len(json['response']['docs'])
-                    if nb_results % 10000 == 0:
-                        LOGGER.info('read %s docs of %s (%.2f %% done)', nb_results, nb_total,
-                                    (100 * nb_results) / nb_total)
-                    yield json['response']['docs']
-                else:
-                    cursor_ended = True
+            with self.profiler.stage(STAGE_SOLR_FETCH):
+                async with self.aiohttp_session.get(self.solr_url + '/select/', params=kwargs) as resp:
+                    raw_body = await resp.read()
+                    content_encoding = resp.headers.get('Content-Encoding')
+            with self.profiler.stage(STAGE_JSON_DECODE):
+                body = _decompress(raw_body, content_encoding)
+                json = loads(body.decode('utf-8'))
+            self.transport_stats.add_received(len(body), len(raw_body))
+            if kwargs['cursorMark'] == '*':
+                nb_total = int(json['response']['numFound'])
+                LOGGER.info('found %s documents', json['response']['numFound'])
+            if kwargs['cursorMark'] != json['nextCursorMark']:
+                kwargs['cursorMark'] = json['nextCursorMark']
+                nb_results += len(json['response']['docs'])
+                if nb_results % 10000 == 0:
+                    LOGGER.info('read %s docs of %s (%.2f %% done, memory used %s)', nb_results, nb_total,
+                                (100 * nb_results) / nb_total, self.memory_budget)
+                yield json['response']['docs']
+            else:
+                cursor_ended = True
         LOGGER.info('processed %s documents', nb_results)
 
+
+class Solr2EsVerifier(object):
+    """
+    Checks that the solr ids are the ones of the elasticsearch index. The id space is split in ranges (lo, hi],
+    first in nb_ranges ranges spread between the min and max solr ids (stats component), then the mismatching ones
+    in nb_ranges ranges at split points read during their digest pass. For each level of ranges, the solr ids of the
+    ranges are streamed in parallel with cursors (range filter queries) while the elasticsearch ids are streamed with
+    a scroll sliced in nb_slices, sorted by _doc and bucketed into the ranges client side, so that neither side sorts
+    or deep pages. Ranges with less than leaf_size solr ids compare their ids to find the missing and extra ones,
+    the other ones compare their IdsDigest.
+    The ids are ordered like solr does : as strings, or as integers for a numeric id field. Floating point id
+    fields are not supported.
+    """
+    def __init__(self, solr, es, index_name, solr_id_field=DEFAULT_ID_FIELD, solr_filter_query='*',
+                 nb_ranges=DEFAULT_VERIFY_RANGES, leaf_size=DEFAULT_VERIFY_LEAF_SIZE, page_size=1000, scroll='5m',
+                 nb_slices=None) -> None:
+        if nb_ranges < 2:
+            raise ValueError('a range must be split in at least 2 ranges (nb_ranges=%s)' % nb_ranges)
+        self.solr = solr
+        self.es = es
+        self.index_name = index_name
+        self.solr_id_field = solr_id_field
+        self.solr_filter_query = solr_filter_query
+        self.nb_ranges = nb_ranges
+        self.nb_slices = nb_ranges if nb_slices is None else nb_slices
+        self.leaf_size = max(leaf_size, 1)
+        self.page_size = page_size
+        self.scroll = scroll
+        self.id_type = str
+
+    def verify(self) -> tuple:
+        """
+        :return: (missing, extra) sorted lists of the solr ids missing in elasticsearch and of the extra elasticsearch ids
+        """
+        missing, extra = [], set()
+        ranges = self._first_ranges()
+        with ThreadPoolExecutor(max_workers=self.nb_ranges + self.nb_slices) as executor:
+            while len(ranges) > 0:
+                LOGGER.info('verifying %s ranges', len(ranges))
+                solr_counts = list(executor.map(lambda r: self._solr_count(*r), ranges))
+                leaves = [solr_count <= self.leaf_size for solr_count in solr_counts]
+                es_futures = [executor.submit(self._es_ranges, ranges, leaves, i) for i in range(self.nb_slices)]
+                solr_ranges = list(executor.map(lambda args: self._solr_range(*args), (
+                    (lo, hi, solr_count, leaf) for (lo, hi), solr_count, leaf in zip(ranges, solr_counts, leaves))))
+                es_ranges = [set() if leaf else IdsDigest() for leaf in leaves]
+                for es_future in es_futures:
+                    slice_ranges, not_ids = es_future.result()
+                    extra |= not_ids
+                    for es_range, slice_range in zip(es_ranges, slice_ranges):
+                        es_range.update(slice_range)
+                next_ranges = []
+                for leaf, (solr_range, bounds), es_range in zip(leaves, solr_ranges, es_ranges):
+                    if leaf:
+                        missing += solr_range - es_range
+                        extra |= es_range - solr_range
+                    elif solr_range != es_range:
+                        next_ranges += list(zip(bounds[:-1], bounds[1:]))
+                ranges = next_ranges
+        LOGGER.info('verified index %s : %s missing and %s extra documents', self.index_name, len(missing), len(extra))
+        return sorted(missing), sorted(extra)
+
+    def _first_ranges(self) -> list:
+        """nb_ranges ranges evenly spread between the min and max solr ids, the first and last ones being unbounded"""
+        results = self.solr.search('*:*', fq=[self.solr_filter_query], fl=self.solr_id_field, rows=1,
+                                   stats='true', **{'stats.field': self.solr_id_field})
+        if len(results.docs) == 0:
+            return [(None, None)]
+        if isinstance(results.docs[0][self.solr_id_field], float):
+            raise ValueError('floating point id field %s is not supported' % self.solr_id_field)
+        self.id_type = int if isinstance(results.docs[0][self.solr_id_field], int) else str
+        stats = results.stats['stats_fields'][self.solr_id_field]
+        lo, hi = self.id_type(stats['min']), self.id_type(stats['max'])
+        split_points = _int_split_points(lo, hi, self.nb_ranges) if self.id_type is int else \
+            _string_split_points(lo, hi, self.nb_ranges)
+        bounds = [None] + split_points + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _solr_range(self, lo, hi, solr_count, leaf) -> tuple:
+        """
+        :return: (ids, None) for a leaf range, else (IdsDigest, bounds) with the bounds splitting the range
+        in nb_ranges ranges read during the same cursor pass
+        """
+        if leaf:
+            return set(self._solr_ids(lo, hi)), None
+        split_positions = {solr_count * i // self.nb_ranges - 1 for i in range(1, self.nb_ranges)}
+        digest, bounds = IdsDigest(), [lo]
+        for id_value in self._solr_ids(lo, hi):
+            if digest.count in split_positions and digest.count < solr_count - 1:
+                bounds.append(self.id_type(id_value))
+            digest.add(id_value)
+        bounds.append(hi)
+        return digest, bounds
+
+    def _es_ranges(self, ranges, leaves, slice_id) -> tuple:
+        """
+        :return: the set of the elasticsearch ids of each leaf range and the IdsDigest of the other ranges for
+        the scroll slice slice_id, and the set of the ids that cannot be solr ids (not integers for a numeric id field)
+        """
+        keys = [(0, self.id_type()) if lo is None else (1, lo) for lo, _ in ranges]
+        es_ranges = [set() if leaf else IdsDigest() for leaf in leaves]
+        not_ids = set()
+        for id_value in self._es_ids(slice_id):
+            try:
+                key = self.id_type(id_value)
+            except ValueError:
+                not_ids.add(id_value)
+                continue
+            i = bisect_left(keys, (1, key)) - 1
+            if i >= 0 and (ranges[i][1] is None or key <= ranges[i][1]):
+                es_ranges[i].add(id_value)
+        return es_ranges, not_ids
+
+    def _solr_count(self, lo, hi) -> int:
+        return self.solr.search('*:*', fq=[self.solr_filter_query, self._solr_range_query(lo, hi)], rows=0).hits
+
+    def _solr_ids(self, lo, hi):
+        kwargs = dict(fq=[self.solr_filter_query, self._solr_range_query(lo, hi)], cursorMark='*',
+                      fl=self.solr_id_field, sort='%s asc' % self.solr_id_field, rows=self.page_size)
+        while True:
+            results = self.solr.search('*:*', **kwargs)
+            for doc in results.docs:
+                yield str(doc[self.solr_id_field])
+            if kwargs['cursorMark'] == results.nextCursorMark:
+                return
+            kwargs['cursorMark'] = results.nextCursorMark
+
+    def _es_ids(self, slice_id):
+        """the ids of the slice slice_id of the index, streamed with a scroll in index order"""
+        body = {'query': {'match_all': {}}, '_source': False, 'sort': ['_doc']}
+        if self.nb_slices > 1:
+            body['slice'] = {'id': slice_id, 'max': self.nb_slices}
+        response = self.es.search(index=self.index_name, scroll=self.scroll, size=self.page_size, body=body)
+        try:
+            while len(response['hits']['hits']) > 0:
+                for hit in response['hits']['hits']:
+                    yield hit['_id']
+                response = self.es.scroll(scroll_id=response['_scroll_id'], scroll=self.scroll)
+        finally:
+            self.es.clear_scroll(scroll_id=response['_scroll_id'], ignore=(404,))
+
+    def _solr_range_query(self, lo, hi) -> str:
+        return '%s:%s TO %s]' % (self.solr_id_field, '[*' if lo is None else '{%s' % _solr_term(lo),
+                                 '*' if hi is None else _solr_term(hi))
+
+
+def _solr_term(value) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _int_split_points(lo, hi, nb_ranges) -> list:
+    """the points splitting [lo, hi] in nb_ranges ranges"""
+    split_points = []
+    for i in range(1, nb_ranges):
+        split_point = lo + (hi - lo) * i // nb_ranges
+        if len(split_points) == 0 or split_point > split_points[-1]:
+            split_points.append(split_point)
+    return split_points
+
+
+def _string_split_points(lo, hi, nb_ranges, nb_chars=8) -> list:
+    """
+    strings evenly spread from lo to hi, reading the nb_chars chars following their common prefix as the digits
+    of a number whose base spans their code points
+    """
+    prefix = os.path.commonprefix([lo, hi])
+    lo_tail, hi_tail = lo[len(prefix):len(prefix) + nb_chars], hi[len(prefix):len(prefix) + nb_chars]
+    if len(lo_tail + hi_tail) == 0:
+        return [lo]
+    first = ord(min(lo_tail + hi_tail))
+    base = ord(max(lo_tail + hi_tail)) - first + 1
+    width = max(len(lo_tail), len(hi_tail))
+
+    def to_number(tail):
+        return reduce(lambda number, char: number * base + ord(char) - first, tail.ljust(width, chr(first)), 0)
+
+    def to_string(number):
+        chars = []
+        for _ in range(0, width):
+            number, digit = divmod(number, base)
+            chars.append(chr(first + digit))
+        return prefix + ''.join(reversed(chars)).rstrip(chr(first))
+
+    split_points = []
+    for split_number in _int_split_points(to_number(lo_tail), to_number(hi_tail), nb_ranges):
+        split_point = to_string(split_number)
+        if len(split_points) == 0 or split_point > split_points[-1]:
+            split_points.append(split_point)
+    return split_points
+
+
+class IdsDigest(object):
+    """
+    Count and digest of ids, independent of their order : the sum of the ids md5 modulo 2^64.
+    """
+    def __init__(self, ids=()) -> None:
+        self.count = 0
+        self.digest = 0
+        for id_value in ids:
+            self.add(id_value)
+
+    def add(self, id_value):
+        self.count += 1
+        self.digest = (self.digest + int.from_bytes(hashlib.md5(id_value.encode('utf-8')).digest()[:8], 'little')) \
+            & 0xffffffffffffffff
+
+    def update(self, other):
+        self.count += other.count
+        self.digest = (self.digest + other.digest) & 0xffffffffffffffff
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IdsDigest) and (self.count, self.digest) == (other.count, other.digest)
+
+    def __repr__(self) -> str:
+        return 'IdsDigest(%s, %x)' % (self.count, self.digest)
+
+
+class MigrationJob(object):
+    """
+    A solr core to migrate into an elasticsearch index, scheduled by MigrationScheduler.
+    """
+    def __init__(self, solr, index_name, mapping=None, translation_map=TranslationMap(), solr_filter_query='*',
+                 sort_field=DEFAULT_ID_FIELD, solr_rows=500, solr_fields='*', exclude_solr_id=False) -> None:
+        self.solr = solr
+        self.index_name = index_name
+        self.mapping = mapping
+        self.translation_map = translation_map
+        self.solr_filter_query = solr_filter_query
+        self.sort_field = sort_field
+        self.solr_rows = solr_rows
+        self.solr_fields = solr_fields
+        self.exclude_solr_id = exclude_solr_id
+        self.results = None
+        self.reading = False
+        self.read_done = False
+        self.nb_total = 0
+        self.nb_read = 0
+        self.nb_indexed = 0
+        self.error = None
+
+    def remaining(self) -> int:
+        return self.nb_total - self.nb_read
+
+
+class MigrationScheduler(object):
+    """
+    Migrates several jobs with shared pools of solr reader, translator and elasticsearch writer threads
+    linked by bounded queues. Readers read the next page of the job with the most documents left to read
+    (one reader at a time per job, as solr cursors are sequential). Translation is pure python holding the GIL,
+    so translators do not translate in parallel : they only translate while readers and writers wait for I/O.
+    """
+    def __init__(self, jobs, es, nb_readers=DEFAULT_READERS, nb_translators=DEFAULT_TRANSLATORS,
+                 nb_writers=DEFAULT_WRITERS, buffer_size=DEFAULT_FAN_OUT_BUFFER, refresh=False, memory_budget=None) -> None:
+        self.jobs = jobs
+        self.es = es
+        self.nb_readers = nb_readers
+        self.nb_translators = nb_translators
+        self.nb_writers = nb_writers
+        self.refresh = refresh
+        self.memory_budget = MemoryBudget() if memory_budget is None else memory_budget
+        self.to_translate = Queue(maxsize=buffer_size)
+        self.to_write = Queue(maxsize=buffer_size)
+        self.condition = threading.Condition()
+        self.last_progress = 0
+
+    def run(self) -> int:
+        for job in self.jobs:
+            if not self.es.indices.exists([job.index_name]):
+                self.es.indices.create(job.index_name, body=job.mapping)
+            job.nb_total = job.solr.search('*:*', fq=job.solr_filter_query, rows=0).hits
+            job.results = Solr2Es(job.solr, None, memory_budget=self.memory_budget).produce_results(
+                solr_filter_query=job.solr_filter_query, sort_field=job.sort_field,
+                solr_rows_pagination=job.solr_rows, solr_field_list=job.solr_fields)
+        LOGGER.info('migrating %s documents of %s jobs', sum(job.nb_total for job in self.jobs), len(self.jobs))
+        readers = _start_threads(self._read, self.nb_readers)
+        translators = _start_threads(self._translate, self.nb_translators)
+        writers = _start_threads(self._write, self.nb_writers)
+        _join_threads(readers, self.to_translate, self.nb_translators)
+        _join_threads(translators, self.to_write, self.nb_writers)
+        _join_threads(writers)
+        self._log_progress(force=True)
+        for job in self.jobs:
+            if job.error is not None:
+                LOGGER.error('job for index %s failed : %s', job.index_name, job.error)
+        return sum(job.nb_indexed for job in self.jobs)
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                candidates = [job for job in self.jobs if not job.read_done and not job.reading]
+                if len(candidates) > 0:
+                    job = max(candidates, key=lambda j: j.remaining())
+                    job.reading = True
+                    return job
+                if all(job.read_done for job in self.jobs):
+                    return None
+                self.condition.wait()
+
+    def _read(self):
+        for job in iter(self._next_job, None):
+            try:
+                self.memory_budget.wait()
+                results = next(job.results, None)
+                if results is None:
+                    job.read_done = True
+                else:
+                    job.nb_read += len(results)
+                    self.to_translate.put((job, results, self.memory_budget.acquire(results)))
+            except Exception as e:
+                LOGGER.exception('reading solr for index %s failed', job.index_name)
+                job.error = e
+                job.read_done = True
+            with self.condition:
+                job.reading = False
+                self.condition.notify_all()
+
+    def _translate(self):
+        for job, results, nb_bytes in iter(self.to_translate.get, None):
+            try:
+                actions_as_list = create_es_actions(job.index_name, results, job.translation_map, job.exclude_solr_id)
+                actions = '\n'.join(dumps(d) for d in chain(*actions_as_list))
+                nb_bytes += self.memory_budget.add(_actions_size(actions_as_list) + sys.getsizeof(actions))
+                self.to_write.put((job, len(results), actions, nb_bytes))
+            except Exception as e:
+                LOGGER.exception('translating documents for index %s failed', job.index_name)
+                job.error = e
+                self.memory_budget.release(nb_bytes)
+
+    def _write(self):
+        for job, nb_docs, actions, nb_bytes in iter(self.to_write.get, None):
+            try:
+                response = self.es.bulk(actions, job.index_name, DEFAULT_ES_DOC_TYPE, refresh=self.refresh)
+                nb_indexed = nb_docs - _nb_bulk_errors(response)
+            except Exception as e:
+                LOGGER.exception('bulk to index %s failed', job.index_name)
+                job.error = e
+                nb_indexed = 0
+            finally:
+                self.memory_budget.release(nb_bytes)
+            with self.condition:
+                job.nb_indexed += nb_indexed
+            self._log_progress()
+
+    def _log_progress(self, force=False):
+        with self.condition:
+            if not force and time.time() - self.last_progress < PROGRESS_LOG_INTERVAL:
+                return
+            self.last_progress = time.time()
+        for job in self.jobs:
+            LOGGER.info('index %s : indexed %s docs of %s (%.2f %% done)', job.index_name, job.nb_indexed,
+                        job.nb_total, _percent(job.nb_indexed, job.nb_total))
+        nb_indexed, nb_total = sum(job.nb_indexed for job in self.jobs), sum(job.nb_total for job in self.jobs)
+        LOGGER.info('all jobs : indexed %s docs of %s (%.2f %% done, memory used %s)', nb_indexed, nb_total,
+                    _percent(nb_indexed, nb_total), self.memory_budget)
+
+
+def _start_threads(target, nb_threads) -> list:
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(nb_threads)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _join_threads(threads, next_queue=None, nb_next_threads=0):
+    """waits for the threads of a stage then stops the ones of the next stage once they have consumed its queue"""
+    for thread in threads:
+        thread.join()
+    for _ in range(nb_next_threads):
+        next_queue.put(None)
+
+
+def _percent(nb, total) -> float:
+    return 100.0 if total == 0 else (100 * nb) / total
+
+
 def create_es_actions(index_name, solr_results, translation_map, exclude_solr_id) -> list:
 
     def create_action(row, translation_map, id_value=None) -> dict:
@@ -188,6 +1448,32 @@ def create_es_actions(index_name, solr_results, translation_map, exclude_solr_id
     return results
 
 
+def create_fan_out_bulks(solr_results, targets, exclude_solr_id) -> list:
+    """
+    Translates the solr results once per distinct translation map (by identity)
+    and returns the _bulk body of each target.
+    """
+    translated = dict()
+    for target in targets:
+        key = id(target.translation_map)
+        if key not in translated:
+            # create_es_actions deletes the id from the rows when exclude_solr_id is set
+            rows = [dict(row) for row in solr_results] if exclude_solr_id else solr_results
+            translated[key] = [(action['index'], dumps(doc)) for action, doc in
+                               create_es_actions(None, rows, target.translation_map, exclude_solr_id)]
+    return ['\n'.join('%s\n%s' % (dumps({'index': dict(index_params, _index=target.index_name)}), doc)
+                      for index_params, doc in translated[id(target.translation_map)]) for target in targets]
+
+
+def _nb_bulk_errors(response) -> int:
+    if not response['errors']:
+        return 0
+    failed = [item for item in response['items'] if 'error' in item['index']]
+    for err in failed:
+        LOGGER.warning(err)
+    return len(failed)
+
+
 def translate_doc(row, translation_map) -> dict:
     def translate(key, value):
         translated_key = _translate_key(key, translation_map.names, translation_map.regexps)
@@ -249,22 +1535,145 @@ def deep_update(d, u):
     return d
 
 
-def migrate(solrhost, eshost, index_name, solrfq, solrid, solrfields, rows, excludesolrid):
-    LOGGER.info('migrate from solr (%s) into elasticsearch (%s) index %s and filter query (%s)', solrhost, eshost, index_name, solrfq)
-    Solr2Es(Solr(solrhost, always_commit=True), Elasticsearch(hosts=eshost)).migrate(index_name, solr_filter_query=solrfq, sort_field=solrid, solr_rows=rows, solr_fields=solrfields, exclude_solr_id= excludesolrid)
+def migrate(solrhost, eshost, index_name, solrfq, solrid, solrfields, rows, excludesolrid, shard_routing=False,
+            source=None, sink=None, max_memory=None, settings=None, profiler=None):
+    LOGGER.info('migrate from %s into %s index %s', 'solr (%s) with filter query (%s)' % (solrhost, solrfq) if source is None else 'files',
+                'elasticsearch (%s)' % eshost if sink is None else 'files (%s)' % sink.prefix, index_name)
+    settings = ConnectionSettings() if settings is None else settings
+    solr = settings.solr(solrhost) if source is None else None
+    es = settings.es(eshost) if sink is None else None
+    try:
+        Solr2Es(solr, es, shard_routing=shard_routing, source=source, sink=sink,
+                memory_budget=MemoryBudget(max_memory), profiler=profiler, client_factory=settings.es).migrate(index_name, solr_filter_query=solrfq, sort_field=solrid, solr_rows=rows, solr_fields=solrfields, exclude_solr_id= excludesolrid)
+    finally:
+        if sink is not None:
+            sink.close()
+    LOGGER.info('transport : %s', settings.stats)
 
-async def aiomigrate(solrhost, eshost, name, solrfq, solrid, solrfields, rows, excludesolrid):
+async def aiomigrate(solrhost, eshost, name, solrfq, solrid, solrfields, rows, excludesolrid, shard_routing=False,
+                     max_memory=None, settings=None, profiler=None):
     LOGGER.info('asyncio migrate from solr (%s) into elasticsearch (%s) index %s '
                 'with filter query (%s) and with id (%s)', solrhost, eshost, name, solrfq, solrid)
-    async with aiohttp.ClientSession() as session:
-        await Solr2EsAsync(session, AsyncElasticsearch(hosts=[eshost]), solrhost).migrate(
-            name, solr_filter_query=solrfq, sort_field=solrid, solr_fields=solrfields, solr_rows_pagination=rows, exclude_solr_id=excludesolrid)
+    settings = ConnectionSettings() if settings is None else settings
+    aes = settings.aes(eshost)
+    async with settings.aiohttp_session() as session:
+        try:
+            await Solr2EsAsync(session, aes, solrhost, shard_routing=shard_routing, memory_budget=AsyncMemoryBudget(max_memory),
+                               transport_stats=settings.stats, profiler=profiler, client_factory=settings.aes).migrate(
+                name, solr_filter_query=solrfq, sort_field=solrid, solr_fields=solrfields, solr_rows_pagination=rows, exclude_solr_id=excludesolrid)
+        finally:
+            await aes.transport.close()
+    LOGGER.info('transport : %s', settings.stats)
+
+
+def migrate_targets(solrhost, eshost, targets_str, solrfq, solrid, solrfields, rows, excludesolrid, buffer_size,
+                    max_memory=None, settings=None):
+    settings = ConnectionSettings() if settings is None else settings
+    targets = _create_targets(targets_str, eshost, settings.es)
+    LOGGER.info('migrate from solr (%s) into elasticsearch indices %s and filter query (%s)', solrhost,
+                [target.index_name for target in targets], solrfq)
+    Solr2Es(settings.solr(solrhost), None, memory_budget=MemoryBudget(max_memory)).migrate_to_targets(
+        targets, solr_filter_query=solrfq, sort_field=solrid, solr_rows=rows, solr_fields=solrfields,
+        exclude_solr_id=excludesolrid, buffer_size=buffer_size)
+    LOGGER.info('transport : %s', settings.stats)
+
+
+async def aiomigrate_targets(solrhost, eshost, targets_str, solrfq, solrid, solrfields, rows, excludesolrid, buffer_size,
+                             max_memory=None, settings=None):
+    settings = ConnectionSettings() if settings is None else settings
+    targets = _create_targets(targets_str, eshost, settings.aes)
+    LOGGER.info('asyncio migrate from solr (%s) into elasticsearch indices %s '
+                'with filter query (%s) and with id (%s)', solrhost, [target.index_name for target in targets], solrfq, solrid)
+    async with settings.aiohttp_session() as session:
+        try:
+            await Solr2EsAsync(session, None, solrhost, memory_budget=AsyncMemoryBudget(max_memory),
+                               transport_stats=settings.stats).migrate_to_targets(
+                targets, solr_filter_query=solrfq, sort_field=solrid, solr_fields=solrfields, solr_rows_pagination=rows,
+                exclude_solr_id=excludesolrid, buffer_size=buffer_size)
+        finally:
+            await asyncio.gather(*(es.transport.close() for es in {id(t.es): t.es for t in targets}.values()))
+    LOGGER.info('transport : %s', settings.stats)
+
+
+def verify(solrhost, eshost, index_name, solrfq, solrid, nb_ranges, settings=None):
+    LOGGER.info('verify solr (%s) with filter query (%s) against elasticsearch (%s) index %s', solrhost, solrfq, eshost, index_name)
+    settings = ConnectionSettings() if settings is None else settings
+    missing, extra = Solr2EsVerifier(settings.solr(solrhost), settings.es(eshost), index_name, solr_id_field=solrid,
+                                     solr_filter_query=solrfq, nb_ranges=nb_ranges).verify()
+    for id_value in missing:
+        print('missing\t%s' % id_value)
+    for id_value in extra:
+        print('extra\t%s' % id_value)
+    return len(missing) + len(extra) == 0
+
+
+def _create_targets(targets_str, default_eshost, client_factory) -> list:
+    """
+    targets_str is a JSON list (or @file) of {"index": ..., "eshost": ..., "mapping": ..., "translationmap": ...}
+    where mapping and translationmap can be JSON objects or @files. Clients and translation maps are shared
+    between targets with the same host and the same translation map.
+    """
+    clients = dict()
+    translation_maps = dict()
+    targets = []
+    for target in _get_dict_from_string_or_file(targets_str):
+        eshost = target.get('eshost', default_eshost)
+        if eshost not in clients:
+            clients[eshost] = client_factory(eshost)
+        mapping = target.get('mapping')
+        targets.append(EsTarget(clients[eshost], target['index'], None if mapping is None else _as_dict(mapping),
+                                _get_translation_map(translation_maps, target.get('translationmap'))))
+    return targets
+
+
+def migrate_manifest(solrhost, eshost, manifest_str, rows, excludesolrid, nb_readers, nb_translators, nb_writers,
+                     max_memory=None, settings=None, solrfields='*'):
+    settings = ConnectionSettings() if settings is None else settings
+    jobs = _create_jobs(manifest_str, lambda core_name: settings.solr('http://%s/solr/%s' % (solrhost, core_name)),
+                        rows, excludesolrid, solrfields)
+    LOGGER.info('migrate %s solr cores from %s into elasticsearch (%s)', len(jobs), solrhost, eshost)
+    MigrationScheduler(jobs, settings.es(eshost), nb_readers=nb_readers, nb_translators=nb_translators,
+                       nb_writers=nb_writers, memory_budget=MemoryBudget(max_memory)).run()
+    LOGGER.info('transport : %s', settings.stats)
+    return all(job.error is None for job in jobs)
+
+
+def _create_jobs(manifest_str, solr_factory, rows, exclude_solr_id, solr_fields='*') -> list:
+    """
+    manifest_str is a JSON list (or @file) of {"core": ..., "index": ..., "solrfq": ..., "solrid": ..., "solrfields": ...,
+    "mapping": ..., "translationmap": ...} where only core is mandatory (index is the core name by default, solrfields
+    is solr_fields by default) and mapping and translationmap can be JSON objects or @files.
+    """
+    translation_maps = dict()
+    jobs = []
+    for job in _get_dict_from_string_or_file(manifest_str):
+        mapping = job.get('mapping')
+        jobs.append(MigrationJob(solr_factory(job['core']), job.get('index', job['core']),
+                                 mapping=None if mapping is None else _as_dict(mapping),
+                                 translation_map=_get_translation_map(translation_maps, job.get('translationmap')),
+                                 solr_filter_query=job.get('solrfq', '*'), sort_field=job.get('solrid', DEFAULT_ID_FIELD),
+                                 solr_rows=rows, solr_fields=job.get('solrfields', solr_fields),
+                                 exclude_solr_id=exclude_solr_id))
+    return jobs
+
+
+def _get_translation_map(translation_maps, value) -> TranslationMap:
+    """returns the same TranslationMap for the same translation map dicts"""
+    translation_map_dict = _as_dict(value)
+    if repr(translation_map_dict) not in translation_maps:
+        translation_maps[repr(translation_map_dict)] = TranslationMap(translation_map_dict)
+    return translation_maps[repr(translation_map_dict)]
+
+
+def _as_dict(value):
+    return _get_dict_from_string_or_file(value) if value is None or isinstance(value, str) else value
 
 
 def usage(argv):
     print('Usage: %s action' % argv[0])
     print('\t-m|--migrate: migrate solr to elasticsearch')
     print('\t-t|--test: test solr/elasticsearch connections')
+    print('\t--verify: print the solr ids missing in elasticsearch and the extra elasticsearch ids')
     print('\t-a|--async: use python 3 asyncio')
     print('\t--solrhost: solr host (default \'solr\')')
     print('\t--solrfq: solr filter query (default \'*\')')
@@ -273,6 +1682,23 @@ def usage(argv):
     print('\t--index: index name (default solr core name)')
     print('\t--core: core name (default \'solr2es\')')
     print('\t--eshost: elasticsearch url (default \'elasticsearch\')')
+    print('\t--shardrouting: send bulks directly to the nodes holding the primary shards')
+    print('\t--source: read solr docs from JSON/JSON lines export files (comma separated globs, .gz supported) instead of solr')
+    print('\t--sink: write _bulk NDJSON files with this path prefix instead of indexing into elasticsearch')
+    print('\t--sinksize: maximum size of a _bulk NDJSON file (default 100M)')
+    print('\t--targets: JSON list (or @file) of elasticsearch targets {"index", "eshost", "mapping", "translationmap"} to migrate to from one solr read')
+    print('\t--fanoutbuffer: number of pages buffered for each target (default %d)' % DEFAULT_FAN_OUT_BUFFER)
+    print('\t--verifyranges: number of id ranges verified in parallel, at least 2 (default %d)' % DEFAULT_VERIFY_RANGES)
+    print('\t--manifest: JSON list (or @file) of jobs {"core", "index", "solrfq", "solrid", "solrfields", "mapping", "translationmap"} to migrate together')
+    print('\t--readers: number of solr reader threads shared by the manifest jobs (default %d)' % DEFAULT_READERS)
+    print('\t--translators: number of translator threads shared by the manifest jobs, they hold the GIL so more than 2 rarely helps (default %d)' % DEFAULT_TRANSLATORS)
+    print('\t--writers: number of elasticsearch writer threads shared by the manifest jobs (default %d)' % DEFAULT_WRITERS)
+    print('\t--maxmemory: maximum size of the solr documents held in memory before reading is paused, e.g. 2G (default no limit)')
+    print('\t--poolsize: number of keep-alive connections pooled for each solr/elasticsearch host (default %d)' % DEFAULT_POOL_SIZE)
+    print('\t--keepalive: seconds an idle pooled connection is kept open with asyncio (default %d)' % DEFAULT_KEEPALIVE)
+    print('\t--timeout: solr/elasticsearch request timeout in seconds (default %d)' % DEFAULT_TIMEOUT)
+    print('\t--compress: gzip the elasticsearch bulk requests')
+    print('\t--profile: sample the migration stacks and write per stage flame graph files and time summary into this directory')
 
 
 def as_translation_map(dct):
@@ -292,11 +1718,34 @@ def _get_dict_from_string_or_file(input_str) -> dict:
         return loads(input_str, object_hook=as_translation_map)
 
 
+def _check_options(options):
+    """raises GetoptError for the options that would be ignored because of another one"""
+    given = set(opt for opt, _ in options)
+    ignored_options = {'--source': ('--solrfq', '--solrid', '--solrfields'),
+                       '--targets': ('--shardrouting', '--profile', '--source', '--sink'),
+                       '--manifest': ('-a', '--async', '--shardrouting', '--profile', '--source', '--sink', '--targets',
+                                      '--core', '--index', '--solrfq', '--solrid')}
+    for option, ignored in ignored_options.items():
+        conflicts = [opt for opt in ignored if option in given and opt in given]
+        if len(conflicts) > 0:
+            raise getopt.GetoptError('%s cannot be used with %s' % (option, ', '.join(conflicts)), conflicts[0])
+
+
+def _parse_size(size_str) -> int:
+    unit = size_str[-1:].upper()
+    if unit in SIZE_UNITS:
+        return int(float(size_str[:-1]) * SIZE_UNITS[unit])
+    return int(size_str)
+
+
 def main():
     options, remainder = getopt.gnu_getopt(sys.argv[1:], 'hmdtra',
-            ['help', 'migrate', 'test', 'async', 'solrhost=', 'eshost=',
+            ['help', 'migrate', 'test', 'verify', 'async', 'solrhost=', 'eshost=',
              'index=', 'core=', 'solrfq=', 'solrid=',
-             'rows=', 'solrfields=', 'excludesolrid='])
+             'rows=', 'solrfields=', 'excludesolrid=', 'shardrouting', 'source=', 'sink=', 'sinksize=',
+             'targets=', 'fanoutbuffer=', 'verifyranges=',
+             'manifest=', 'readers=', 'translators=', 'writers=', 'maxmemory=',
+             'poolsize=', 'keepalive=', 'timeout=', 'compress', 'profile='])
     if len(sys.argv) == 1:
         usage(sys.argv)
         sys.exit()
@@ -313,6 +1762,18 @@ def main():
     action = 'migrate'
     excludesolrid = False
     rows = 500
+    shard_routing = False
+    source = None
+    sink_prefix = None
+    sink_size = DEFAULT_SINK_FILE_SIZE
+    targets = None
+    fan_out_buffer = DEFAULT_FAN_OUT_BUFFER
+    verify_ranges = DEFAULT_VERIFY_RANGES
+    manifest = None
+    nb_readers, nb_translators, nb_writers = DEFAULT_READERS, DEFAULT_TRANSLATORS, DEFAULT_WRITERS
+    max_memory = None
+    pool_size, keepalive, timeout, compress = DEFAULT_POOL_SIZE, DEFAULT_KEEPALIVE, DEFAULT_TIMEOUT, False
+    profiler = None
     for opt, arg in options:
         if opt in ('-h', '--help'):
             usage(sys.argv)
@@ -334,7 +1795,7 @@ def main():
             solr_fields = arg
 
         if opt == '--rows':
-            rows = arg
+            rows = int(arg)
 
         if opt == '--eshost':
             eshost = arg
@@ -348,20 +1809,87 @@ def main():
         if opt == '--excludesolrid':
             excludesolrid = arg
 
+        if opt == '--shardrouting':
+            shard_routing = True
+
+        if opt == '--source':
+            source = JsonFileSource.from_patterns(arg)
+
+        if opt == '--sink':
+            sink_prefix = arg
+
+        if opt == '--sinksize':
+            sink_size = _parse_size(arg)
+
+        if opt == '--targets':
+            targets = arg
+
+        if opt == '--fanoutbuffer':
+            fan_out_buffer = int(arg)
+
+        if opt == '--verifyranges':
+            verify_ranges = int(arg)
+
+        if opt == '--manifest':
+            manifest = arg
+
+        if opt == '--readers':
+            nb_readers = int(arg)
+
+        if opt == '--translators':
+            nb_translators = int(arg)
+
+        if opt == '--writers':
+            nb_writers = int(arg)
+
+        if opt == '--maxmemory':
+            max_memory = _parse_size(arg)
+
+        if opt == '--poolsize':
+            pool_size = int(arg)
+
+        if opt == '--keepalive':
+            keepalive = int(arg)
+
+        if opt == '--timeout':
+            timeout = int(arg)
+
+        if opt == '--compress':
+            compress = True
+
+        if opt == '--profile':
+            profiler = SamplingProfiler(arg)
+
 
         elif opt in ('-m', '--migrate'):
             action = 'migrate'
         elif opt in ('-t', '--test'):
             action = 'test'
+        elif opt == '--verify':
+            action = 'verify'
 
+    _check_options(options)
     if index_name is None:
         index_name = core_name
 
     solrurl = 'http://%s/solr/%s' % (solrhost, core_name)
+    settings = ConnectionSettings(pool_size, keepalive, timeout, compress)
 
-    if action == 'migrate':
-        aioloop.run_until_complete(aiomigrate(solrurl, eshost, index_name, solrfq, solrid, solr_fields, rows, excludesolrid)) if with_asyncio \
-            else migrate(solrurl, eshost, index_name, solrfq, solrid, solr_fields, rows, excludesolrid)
+    if action == 'migrate' and manifest is not None:
+        if not migrate_manifest(solrhost, eshost, manifest, rows, excludesolrid, nb_readers, nb_translators, nb_writers, max_memory, settings, solr_fields):
+            sys.exit(1)
+    elif action == 'migrate' and targets is not None:
+        aioloop.run_until_complete(aiomigrate_targets(solrurl, eshost, targets, solrfq, solrid, solr_fields, rows, excludesolrid, fan_out_buffer, max_memory, settings)) if with_asyncio \
+            else migrate_targets(solrurl, eshost, targets, solrfq, solrid, solr_fields, rows, excludesolrid, fan_out_buffer, max_memory, settings)
+    elif action == 'migrate' and (source is not None or sink_prefix is not None):
+        migrate(solrurl, eshost, index_name, solrfq, solrid, solr_fields, rows, excludesolrid, shard_routing, source,
+                None if sink_prefix is None else BulkFileSink(sink_prefix, sink_size), max_memory, settings, profiler)
+    elif action == 'migrate':
+        aioloop.run_until_complete(aiomigrate(solrurl, eshost, index_name, solrfq, solrid, solr_fields, rows, excludesolrid, shard_routing, max_memory, settings, profiler)) if with_asyncio \
+            else migrate(solrurl, eshost, index_name, solrfq, solrid, solr_fields, rows, excludesolrid, shard_routing, max_memory=max_memory, settings=settings, profiler=profiler)
+    elif action == 'verify':
+        if not verify(solrurl, eshost, index_name, solrfq, solrid, verify_ranges, settings):
+            sys.exit(1)
     elif action == 'test':
         solr_status = loads(SolrCoreAdmin('http://%s:8983/solr/admin/cores?action=STATUS&core=%s' % (solrhost, core_name)).status())
         LOGGER.info('Elasticsearch ping on %s is %s', eshost, 'OK' if Elasticsearch(host=eshost).ping() else 'KO')
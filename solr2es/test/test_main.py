@@ -1,8 +1,12 @@
+import getopt
 import os
 import re
 import unittest
 
-from solr2es.__main__ import _get_dict_from_string_or_file
+from nose.tools import raises
+
+from solr2es.__main__ import _get_dict_from_string_or_file, _parse_size, _create_targets, \
+    _create_jobs, _check_options
 
 
 class TestMain(unittest.TestCase):
@@ -19,3 +23,63 @@ class TestMain(unittest.TestCase):
         filename = '@' + os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data/translation_map.json')
         self.assertEqual({'field1': {'name': 'value1'}}, _get_dict_from_string_or_file(filename))
 
+    def test_parse_size(self):
+        self.assertEqual(1000, _parse_size('1000'))
+        self.assertEqual(2 * 1024 ** 3, _parse_size('2G'))
+        self.assertEqual(512 * 1024, _parse_size('0.5m'))
+
+    def test_create_targets(self):
+        targets = _create_targets('[{"index": "blue"}, {"index": "green", "eshost": "es2", "mapping": {"mappings": {}}, '
+                                  '"translationmap": {"a": {"name": "b"}}}, {"index": "green2", "eshost": "es2", '
+                                  '"translationmap": {"a": {"name": "b"}}}]', 'es1', lambda host: host)
+
+        self.assertEqual(['blue', 'green', 'green2'], [target.index_name for target in targets])
+        self.assertEqual(['es1', 'es2', 'es2'], [target.es for target in targets])
+        self.assertEqual([None, {'mappings': {}}, None], [target.mapping for target in targets])
+        self.assertEqual({'a': 'b'}, targets[1].translation_map.names)
+        self.assertIs(targets[1].translation_map, targets[2].translation_map)
+
+    def test_create_jobs(self):
+        jobs = _create_jobs('[{"core": "core1"}, {"core": "core2", "index": "index2", "solrfq": "type:doc", "solrid": "my_id", '
+                            '"translationmap": {"a": {"name": "b"}}}]', lambda core: 'solr/' + core, 100, False)
+
+        self.assertEqual(['solr/core1', 'solr/core2'], [job.solr for job in jobs])
+        self.assertEqual(['core1', 'index2'], [job.index_name for job in jobs])
+        self.assertEqual(['*', 'type:doc'], [job.solr_filter_query for job in jobs])
+        self.assertEqual(['id', 'my_id'], [job.sort_field for job in jobs])
+        self.assertEqual({'a': 'b'}, jobs[1].translation_map.names)
+        self.assertEqual([100, 100], [job.solr_rows for job in jobs])
+        self.assertEqual(['*', '*'], [job.solr_fields for job in jobs])
+
+    def test_create_jobs_with_solr_fields(self):
+        jobs = _create_jobs('[{"core": "core1"}, {"core": "core2", "solrfields": "id,name"}]',
+                            lambda core: 'solr/' + core, 100, False, 'id,title')
+
+        self.assertEqual(['id,title', 'id,name'], [job.solr_fields for job in jobs])
+
+    def test_check_options(self):
+        _check_options([('--source', 'export.jsonl'), ('--index', 'foo')])
+        _check_options([('--solrfq', 'type:doc')])
+
+    @raises(getopt.GetoptError)
+    def test_check_options_source_with_solr_query(self):
+        _check_options([('--source', 'export.jsonl'), ('--solrfq', 'type:doc')])
+
+    @raises(getopt.GetoptError)
+    def test_check_options_targets_with_shard_routing(self):
+        _check_options([('--targets', '[{"index": "blue"}]'), ('--shardrouting', '')])
+
+    @raises(getopt.GetoptError)
+    def test_check_options_targets_with_profile(self):
+        _check_options([('--profile', 'profile'), ('--targets', '[{"index": "blue"}]')])
+
+    @raises(getopt.GetoptError)
+    def test_check_options_manifest_with_async(self):
+        _check_options([('--manifest', '[{"core": "core1"}]'), ('-a', '')])
+
+    @raises(getopt.GetoptError)
+    def test_check_options_manifest_with_index(self):
+        _check_options([('--manifest', '[{"core": "core1"}]'), ('--index', 'foo')])
+
+    def test_check_options_manifest_with_solr_fields(self):
+        _check_options([('--manifest', '[{"core": "core1"}]'), ('--solrfields', 'id,name'), ('--readers', '8')])
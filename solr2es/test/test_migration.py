@@ -1,6 +1,15 @@
+import gzip
 import hashlib
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
 
 import requests
 from elasticsearch import Elasticsearch
@@ -8,7 +17,10 @@ from nose.tools import assert_raises, raises
 from pysolr import Solr, SolrError
 
 from solr2es.__main__ import Solr2Es, DEFAULT_ES_DOC_TYPE, translate_doc, _tuples_to_dict, create_es_actions, \
-    IllegalStateError, TranslationMap
+    IllegalStateError, TranslationMap, ShardRouter, murmur3_es_hash, JsonFileSource, BulkFileSink, \
+    EsTarget, create_fan_out_bulks, Solr2EsVerifier, IdsDigest, _string_split_points, \
+    MigrationJob, MigrationScheduler, MemoryBudget, _docs_size, _actions_size, _format_size, ConnectionSettings, TransportStats, \
+    _decompress, _client_factory_of, _read_json, SamplingProfiler, STAGE_BULK_WAIT, STAGE_TRANSLATE, STAGE_SOLR_FETCH, STAGE_JSON_DECODE
 
 
 class TestMigration(unittest.TestCase):
@@ -70,6 +82,45 @@ class TestMigration(unittest.TestCase):
         TestMigration.solr.add([{"id": "id_%d" % i, "title": "A %d document" % i} for i in range(0, 12)])
         self.assertEqual(12, self.solr2es.migrate('foo'))
 
+    def test_migrate_to_two_targets_with_different_translation_maps(self):
+        TestMigration.solr.add([{"id": "id_%d" % i, "title": "A %d document" % i} for i in range(0, 12)])
+        targets = [EsTarget(self.es, 'foo'), EsTarget(self.es, 'foo_bis', translation_map=TranslationMap({'title': {'name': 'name'}}))]
+        try:
+            self.assertEqual([12, 12], self.solr2es.migrate_to_targets(targets, solr_rows=5, buffer_size=1))
+
+            self.assertEqual('A 3 document', self.es.get_source(index='foo', doc_type=DEFAULT_ES_DOC_TYPE, id='id_3')['title'])
+            self.assertEqual('A 3 document', self.es.get_source(index='foo_bis', doc_type=DEFAULT_ES_DOC_TYPE, id='id_3')['name'])
+        finally:
+            self.es.indices.delete(index='foo_bis')
+
+    def test_migrate_manifest_jobs(self):
+        TestMigration.solr.add([{"id": "id_%02d" % i, "title": "A %d document" % i} for i in range(0, 30)])
+        jobs = [MigrationJob(TestMigration.solr, 'foo', solr_filter_query='id:id_1*', solr_rows=4),
+                MigrationJob(TestMigration.solr, 'foo_bis', solr_filter_query='-id:id_1*', solr_rows=4,
+                             translation_map=TranslationMap({'title': {'name': 'name'}}))]
+        try:
+            self.assertEqual(30, MigrationScheduler(jobs, TestMigration.es, nb_readers=2, nb_translators=2, nb_writers=2, refresh=True).run())
+
+            self.assertEqual([10, 20], [job.nb_indexed for job in jobs])
+            self.assertEqual('A 3 document', self.es.get_source(index='foo_bis', doc_type=DEFAULT_ES_DOC_TYPE, id='id_03')['name'])
+        finally:
+            self.es.indices.delete(index='foo_bis')
+
+    def test_verify(self):
+        TestMigration.solr.add([{"id": "id_%02d" % i, "title": "A %d document" % i} for i in range(0, 30)])
+        self.solr2es.migrate('foo')
+        TestMigration.es.delete(index='foo', doc_type=DEFAULT_ES_DOC_TYPE, id='id_12', refresh=True)
+        TestMigration.es.index(index='foo', doc_type=DEFAULT_ES_DOC_TYPE, id='id_12b', body={'title': 'extra'}, refresh=True)
+
+        self.assertEqual((['id_12'], ['id_12b']),
+                         Solr2EsVerifier(TestMigration.solr, TestMigration.es, 'foo', nb_ranges=3, leaf_size=5, page_size=4).verify())
+
+    def test_verify_same_ids(self):
+        TestMigration.solr.add([{"id": "id_%02d" % i, "title": "A %d document" % i} for i in range(0, 30)])
+        self.solr2es.migrate('foo')
+
+        self.assertEqual(([], []), Solr2EsVerifier(TestMigration.solr, TestMigration.es, 'foo', nb_ranges=3, leaf_size=5).verify())
+
     def test_migrate_with_es_mapping(self):
         mapping = '{"mappings": {"doc": {"properties": {"my_field": {"type": "keyword"}}}}}'
         self.solr2es.migrate('foo', mapping=mapping)
@@ -258,6 +309,348 @@ class TestTuplesToDict(unittest.TestCase):
                                           ('nested', ('a', (('c', 'content2'), ('d', 'content3'))))]))
 
 
+class TestVerifier(unittest.TestCase):
+    def test_solr_range_query(self):
+        verifier = Solr2EsVerifier(None, None, 'foo', solr_id_field='my_id')
+        self.assertEqual('my_id:[* TO *]', verifier._solr_range_query(None, None))
+        self.assertEqual('my_id:{"a" TO "b"]', verifier._solr_range_query('a', 'b'))
+        self.assertEqual('my_id:{"a\\"b\\\\" TO *]', verifier._solr_range_query('a"b\\', None))
+        self.assertEqual('my_id:{-3 TO 10]', verifier._solr_range_query(-3, 10))
+
+    def test_ids_digest_is_order_independent(self):
+        self.assertEqual(IdsDigest(['a', 'b', 'c']), IdsDigest(['c', 'a', 'b']))
+        self.assertEqual(3, IdsDigest(['a', 'b', 'c']).count)
+        self.assertNotEqual(IdsDigest(['a', 'b', 'c']), IdsDigest(['a', 'b', 'd']))
+        self.assertEqual(IdsDigest(), IdsDigest([]))
+
+    def test_ids_digest_update(self):
+        digest = IdsDigest(['a', 'b'])
+        digest.update(IdsDigest(['c']))
+        self.assertEqual(IdsDigest(['a', 'b', 'c']), digest)
+
+    def test_first_level_is_split(self):
+        verifier = Solr2EsVerifier(FakeVerifySolr(['doc_%03d' % i for i in range(0, 100)]), None, 'foo', nb_ranges=4)
+        self.assertEqual([(None, 'doc_024'), ('doc_024', 'doc_049'), ('doc_049', 'doc_074'), ('doc_074', None)],
+                         verifier._first_ranges())
+
+    def test_first_level_of_numeric_ids(self):
+        verifier = Solr2EsVerifier(FakeVerifySolr(list(range(1, 101))), None, 'foo', nb_ranges=4)
+        self.assertEqual([(None, 25), (25, 50), (50, 75), (75, None)], verifier._first_ranges())
+        self.assertEqual([(None, None)], Solr2EsVerifier(FakeVerifySolr([]), None, 'foo')._first_ranges())
+
+    def test_string_split_points(self):
+        self.assertEqual(['doc_012499', 'doc_024999', 'doc_037499'], _string_split_points('doc_000000', 'doc_049999', 4))
+        self.assertEqual(['x'], _string_split_points('x', 'x', 4))
+
+    def test_verify_with_scroll_and_cursors(self):
+        solr_ids = ['doc_%03d' % i for i in range(0, 100)]
+        es_ids = [id_value for id_value in solr_ids if id_value not in ('doc_007', 'doc_093')] + ['doc_0500', 'a', 'zzz']
+        verifier = Solr2EsVerifier(FakeVerifySolr(solr_ids), FakeVerifyEs(es_ids), 'foo', nb_ranges=3, leaf_size=5, page_size=7)
+
+        self.assertEqual((['doc_007', 'doc_093'], ['a', 'doc_0500', 'zzz']), verifier.verify())
+        self.assertEqual(0, verifier.solr.nb_start_queries)
+        self.assertEqual(verifier.es.nb_scrolls, verifier.es.nb_cleared)
+        self.assertEqual({0, 1, 2}, verifier.es.slices)
+
+    def test_verify_numeric_ids(self):
+        es_ids = [str(i) for i in range(1, 101) if i != 9] + ['1000', '007', 'abc']
+        verifier = Solr2EsVerifier(FakeVerifySolr(list(range(1, 101))), FakeVerifyEs(es_ids), 'foo', nb_ranges=4, leaf_size=5)
+        self.assertEqual((['9'], ['007', '1000', 'abc']), verifier.verify())
+
+    def test_verify_splits_in_two_ranges(self):
+        verifier = Solr2EsVerifier(FakeVerifySolr(['a', 'b', 'c']), FakeVerifyEs(['a', 'c']), 'foo', nb_ranges=2, leaf_size=1)
+        self.assertEqual((['b'], []), verifier.verify())
+
+    @raises(ValueError)
+    def test_verify_needs_two_ranges(self):
+        Solr2EsVerifier(None, None, 'foo', nb_ranges=1)
+
+    @raises(ValueError)
+    def test_verify_rejects_floating_point_ids(self):
+        Solr2EsVerifier(FakeVerifySolr([1.5, 2.5]), None, 'foo').verify()
+
+
+class FakeVerifySolr(object):
+    """solr answering the verifier queries on the id field, with string or numeric ids"""
+    class Results(object):
+        def __init__(self, docs, hits, next_cursor_mark=None, stats=None) -> None:
+            self.docs, self.hits, self.nextCursorMark, self.stats = docs, hits, next_cursor_mark, stats
+
+    def __init__(self, ids) -> None:
+        self.ids = sorted(ids)
+        self.nb_start_queries = 0
+
+    def search(self, q, fq, rows, fl=None, sort=None, start=0, cursorMark=None, stats=None, **kwargs):
+        ids = self.ids
+        if len(fq) > 1:
+            lo, hi = [None if bound == '*' else type(self.ids[0])(bound.strip('"'))
+                      for bound in re.match(r'id:[\[{](.*) TO (.*)\]', fq[1]).groups()]
+            ids = [i for i in self.ids if (lo is None or i > lo) and (hi is None or i <= hi)]
+        self.nb_start_queries += 1 if start > 0 else 0
+        if stats is not None:
+            return FakeVerifySolr.Results([{'id': i} for i in ids[:rows]], len(ids),
+                                          stats={'stats_fields': {'id': {'min': min(ids), 'max': max(ids)}} if ids else {}})
+        if cursorMark is None:
+            return FakeVerifySolr.Results([], len(ids))
+        position = 0 if cursorMark == '*' else int(cursorMark)
+        page = ids[position:position + rows]
+        return FakeVerifySolr.Results([{'id': i} for i in page], len(ids), str(position + len(page)) if page else cursorMark)
+
+
+class FakeVerifyEs(object):
+    """elasticsearch answering sliced scrolls, the ids being dispatched to the slices by their position"""
+    def __init__(self, ids) -> None:
+        self.ids = list(reversed(ids))
+        self.nb_scrolls = 0
+        self.nb_cleared = 0
+        self.slices = set()
+
+    def search(self, index, body, scroll, size):
+        self.nb_scrolls += 1
+        self.size = size
+        slice_id, nb_slices = body['slice']['id'], body['slice']['max']
+        self.slices.add(slice_id)
+        return self.scroll('%s:%s:0' % (slice_id, nb_slices), scroll)
+
+    def scroll(self, scroll_id, scroll):
+        slice_id, nb_slices, position = (int(part) for part in scroll_id.split(':'))
+        ids = self.ids[slice_id::nb_slices]
+        return {'_scroll_id': '%s:%s:%s' % (slice_id, nb_slices, position + self.size),
+                'hits': {'hits': [{'_id': i} for i in ids[position:position + self.size]]}}
+
+    def clear_scroll(self, scroll_id, ignore):
+        self.nb_cleared += 1
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_docs_size(self):
+        docs = [{'id': '123', 'tags': ['ab', 'c']}, {'n': 3}]
+        self.assertEqual(sys.getsizeof(docs[0]) + sys.getsizeof('123') + sys.getsizeof(docs[0]['tags']) +
+                         sys.getsizeof('ab') + sys.getsizeof('c') + sys.getsizeof(docs[1]) + sys.getsizeof(3),
+                         _docs_size(docs))
+
+    def test_actions_size_does_not_count_doc_values(self):
+        actions = create_es_actions('baz', [{'id': '123', 'foo': 'x' * 1000}], TranslationMap(), False)
+        self.assertLess(_actions_size(actions), 1000)
+        self.assertGreater(_actions_size(actions), 0)
+
+    def test_acquire_release(self):
+        budget = MemoryBudget(100000)
+        nb_bytes = budget.acquire([{'id': '123'}])
+        nb_bytes += budget.add(1000)
+
+        self.assertEqual(_docs_size([{'id': '123'}]) + 1000, nb_bytes)
+        self.assertEqual(nb_bytes, budget.used)
+        budget.release(nb_bytes)
+        self.assertEqual(0, budget.used)
+
+    def test_wait_blocks_until_release(self):
+        budget = MemoryBudget(5)
+        nb_bytes = budget.acquire([{'id': '123'}])
+        waiter = threading.Thread(target=budget.wait)
+        waiter.start()
+
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        budget.release(nb_bytes)
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+
+    def test_no_limit(self):
+        budget = MemoryBudget()
+        budget.acquire([{'id': 'x' * 1000}])
+        self.assertFalse(budget.is_exhausted())
+
+    def test_str(self):
+        budget = MemoryBudget(2 * 1024 ** 3)
+        budget.add(1536)
+        self.assertEqual('1.5K of 2.0G', str(budget))
+        self.assertEqual('12B', _format_size(12))
+
+
+class TestTransport(unittest.TestCase):
+    def test_decompress(self):
+        body = b'{"response": {"docs": []}}'
+        self.assertEqual(body, _decompress(gzip.compress(body), 'gzip'))
+        self.assertEqual(body, _decompress(zlib.compress(body), 'deflate'))
+        self.assertEqual(body, _decompress(zlib.compress(body)[2:-4], 'deflate'))
+
+    def test_decompress_plain_body(self):
+        self.assertEqual(b'{}', _decompress(b'{}', None))
+        self.assertEqual(b'[]', _decompress(b'[]', 'gzip'))
+
+    def test_es_compressed_bulks_are_counted(self):
+        settings = ConnectionSettings(pool_size=3, compress=True)
+        connection = settings.es('elasticsearch').transport.get_connection()
+        compressed = connection._gzip_compress(b'{"index": {}}\n' * 100)
+
+        self.assertEqual(3, connection.pool.pool.maxsize)
+        self.assertEqual(1400, settings.stats.sent_logical)
+        self.assertEqual(len(compressed), settings.stats.sent_wire)
+
+    def test_es_compressed_responses_are_counted(self):
+        with GzipBulkServer() as server:
+            settings = ConnectionSettings(compress=True)
+            connection = settings.es(server.url).transport.get_connection()
+            status, _, data = connection.perform_request('POST', '/_bulk', body=b'{"index": {}}\n{}\n')
+
+        self.assertEqual((200, GzipBulkServer.BODY), (status, data.encode()))
+        self.assertEqual(len(GzipBulkServer.BODY), settings.stats.received_logical)
+        self.assertEqual(len(gzip.compress(GzipBulkServer.BODY)), settings.stats.received_wire)
+
+    def test_node_clients_keep_settings(self):
+        settings = ConnectionSettings(pool_size=3, timeout=7, compress=True)
+        connection = settings.es({'host': '10.0.0.1', 'port': 9200, 'use_ssl': True}).transport.get_connection()
+
+        self.assertEqual('https://10.0.0.1:9200', connection.host)
+        self.assertEqual((3, 7, True), (connection.pool.pool.maxsize, connection.timeout, connection.http_compress))
+        self.assertIs(settings.stats, connection.transport_stats)
+
+    def test_solr_clients_share_session(self):
+        settings = ConnectionSettings()
+        self.assertIs(settings.solr('http://solr:8983/solr/core1').session, settings.solr('http://solr:8983/solr/core2').session)
+
+    def test_str(self):
+        stats = TransportStats()
+        stats.add_sent(2048, 512)
+        stats.add_received(3072, 3072)
+        self.assertEqual('sent 2.0K (512B on wire), received 3.0K (3.0K on wire)', str(stats))
+
+
+class GzipBulkServer(HTTPServer):
+    """local elasticsearch _bulk endpoint gzipping its responses when asked with Accept-Encoding"""
+    BODY = dumps({'took': 1, 'errors': False, 'items': [{'index': {'status': 201}}] * 100}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+            body = gzip.compress(GzipBulkServer.BODY) if gzipped else GzipBulkServer.BODY
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), GzipBulkServer.Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = SamplingProfiler(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_sample_is_tagged_with_thread_stage(self):
+        with self.profiler.stage(STAGE_TRANSLATE):
+            self.profiler.sample(0.5)
+        self.profiler.sample(0.25)
+
+        self.assertEqual({STAGE_TRANSLATE: 0.5}, self.profiler.stage_seconds)
+        (stage, stack), = [key for key in self.profiler.samples if key[0] == STAGE_TRANSLATE]
+        self.assertTrue(stack.endswith('test_migration.test_sample_is_tagged_with_thread_stage;solr2es.__main__.sample'))
+
+    def test_json_module_samples_of_solr_fetch_are_json_decode(self):
+        with self.profiler.stage(STAGE_SOLR_FETCH):
+            loads('{"id": "1"}', object_hook=lambda dct: self.profiler.sample(0.1))
+            self.profiler.sample(0.2)
+
+        self.assertEqual({STAGE_JSON_DECODE: 0.1, STAGE_SOLR_FETCH: 0.2}, self.profiler.stage_seconds)
+
+    def test_worker_thread_is_not_sampled_after_its_stage(self):
+        idle_worker_ready, idle_worker_stop = threading.Event(), threading.Event()
+
+        def idle_worker():
+            with self.profiler.stage(STAGE_BULK_WAIT):
+                self.profiler.sample(0.25)
+            idle_worker_ready.set()
+            idle_worker_stop.wait()
+        thread = threading.Thread(target=idle_worker)
+        thread.start()
+        idle_worker_ready.wait()
+        with self.profiler.stage(STAGE_TRANSLATE):
+            self.profiler.sample(0.5)
+        idle_worker_stop.set()
+        thread.join()
+
+        self.assertEqual({STAGE_BULK_WAIT: 0.25, STAGE_TRANSLATE: 0.5}, self.profiler.stage_seconds)
+
+    def test_start_thread_is_sampled_as_other(self):
+        profiler = SamplingProfiler(self.dir.name, interval=60)
+        profiler.start()
+        profiler.sample(0.25)
+        profiler.stop()
+
+        self.assertEqual({'other': 0.25}, profiler.stage_seconds)
+        self.assertEqual({}, profiler.thread_stages)
+
+    def test_untagged_threads_are_not_sampled(self):
+        self.profiler.sample(0.1)
+        self.assertEqual({}, self.profiler.samples)
+
+    def test_write_collapsed_stacks_and_summary(self):
+        with self.profiler.stage(STAGE_TRANSLATE):
+            self.profiler.sample(0.5)
+            self.profiler.sample(1.5)
+        self.profiler.write()
+
+        with open(os.path.join(self.dir.name, 'translate.collapsed')) as f:
+            stack, nb_samples = f.read().splitlines()[0].rsplit(' ', 1)
+        self.assertEqual('2', nb_samples)
+        with open(os.path.join(self.dir.name, 'all.collapsed')) as f:
+            self.assertEqual('translate;%s 2\n' % stack, f.read())
+        with open(os.path.join(self.dir.name, 'summary.txt')) as f:
+            self.assertIn('translate          2.00  100.00        2', f.read())
+
+    def test_start_stop(self):
+        profiler = SamplingProfiler(os.path.join(self.dir.name, 'profile'), interval=0.001)
+        profiler.start()
+        with profiler.stage(STAGE_TRANSLATE):
+            time.sleep(0.05)
+        profiler.stop()
+
+        self.assertGreater(profiler.stage_seconds[STAGE_TRANSLATE], 0)
+        self.assertTrue(os.path.exists(os.path.join(self.dir.name, 'profile', 'summary.txt')))
+
+
+class TestCreateFanOutBulks(unittest.TestCase):
+    def test_one_bulk_per_target(self):
+        translation_map = TranslationMap({'foo': {'name': 'baz'}})
+        bulks = create_fan_out_bulks([{'id': '123', 'foo': 'bar'}],
+                                     [EsTarget(None, 'idx1', translation_map=translation_map),
+                                      EsTarget(None, 'idx2', translation_map=translation_map),
+                                      EsTarget(None, 'idx3')], False)
+
+        self.assertEqual([[{'index': {'_index': 'idx1', '_type': DEFAULT_ES_DOC_TYPE, '_id': '123'}}, {'id': '123', 'baz': 'bar'}],
+                          [{'index': {'_index': 'idx2', '_type': DEFAULT_ES_DOC_TYPE, '_id': '123'}}, {'id': '123', 'baz': 'bar'}],
+                          [{'index': {'_index': 'idx3', '_type': DEFAULT_ES_DOC_TYPE, '_id': '123'}}, {'id': '123', 'foo': 'bar'}]],
+                         [[loads(line) for line in bulk.splitlines()] for bulk in bulks])
+
+    def test_exclude_solr_id_with_several_translation_maps(self):
+        results = [{'id': '123', 'foo': 'bar'}]
+        bulks = create_fan_out_bulks(results, [EsTarget(None, 'idx1'), EsTarget(None, 'idx2', translation_map=TranslationMap())], True)
+
+        self.assertEqual([{'foo': 'bar'}, {'foo': 'bar'}], [loads(bulk.splitlines()[1]) for bulk in bulks])
+        self.assertEqual([{'id': '123', 'foo': 'bar'}], results)
+
+
 class TestCreateEsActions(unittest.TestCase):
     def test_create_es_actions(self):
         self.assertEqual([({'index': {'_index': 'baz', '_type': 'doc', '_id': '123'}}, {'my_id': '123', 'foo': 'bar'})],
@@ -297,3 +690,146 @@ class TestCreateEsActions(unittest.TestCase):
     def test_create_es_action_with_more_than_one_routing_field_in_translation_map(self):
         create_es_actions('baz', [{'id': '321'}], TranslationMap({'route1': {'routing_field': True},
                                                    'route2': {'routing_field': True}}))
+
+
+class TestShardRouter(unittest.TestCase):
+    cluster_state = {
+        'metadata': {'indices': {'baz': {'routing_num_shards': 640, 'settings': {'index': {'number_of_shards': '5'}}}}},
+        'routing_table': {'indices': {'baz': {'shards': {
+            str(shard): [{'node': 'node_%d' % (shard % 2), 'primary': True, 'state': 'STARTED'},
+                         {'node': 'node_%d' % ((shard + 1) % 2), 'primary': False, 'state': 'STARTED'}]
+            for shard in range(0, 5)}}}}
+    }
+    nodes_info = {'nodes': {'node_0': {'http': {'publish_address': 'es0/10.0.0.1:9200'}},
+                            'node_1': {'http': {'publish_address': '10.0.0.2:9200'}}}}
+
+    def setUp(self):
+        self.router = ShardRouter.from_cluster_state('baz', self.cluster_state, self.nodes_info, lambda host: host)
+
+    def test_murmur3_es_hash(self):
+        self.assertEqual(0, murmur3_es_hash(''))
+        self.assertEqual(-675079799, murmur3_es_hash('hello'))
+
+    def test_clients_per_primary_node(self):
+        self.assertEqual({'node_0': {'host': '10.0.0.1', 'port': 9200}, 'node_1': {'host': '10.0.0.2', 'port': 9200}},
+                         self.router.clients)
+
+    def test_node_clients_keep_base_host_settings(self):
+        router = ShardRouter.from_cluster_state('baz', self.cluster_state, self.nodes_info, lambda host: host,
+                                                {'host': 'es', 'port': 443, 'use_ssl': True, 'http_auth': 'user:pass'})
+        self.assertEqual({'host': '10.0.0.2', 'port': 9200, 'use_ssl': True, 'http_auth': 'user:pass'}, router.clients['node_1'])
+
+    def test_client_factory_of(self):
+        es = Elasticsearch(hosts=['https://user:pass@es:443'], timeout=7, http_compress=True)
+        node_es = _client_factory_of(es)({'host': '10.0.0.1', 'port': 9200, 'use_ssl': True, 'http_auth': 'user:pass'})
+        connection = node_es.transport.get_connection()
+
+        self.assertEqual('https://10.0.0.1:9200', connection.host)
+        self.assertEqual(7, connection.timeout)
+        self.assertTrue(connection.http_compress)
+        self.assertIn('authorization', connection.headers)
+
+    def test_shard_for_id(self):
+        self.assertEqual((-675079799 % 640) // 128, self.router.shard_for({'index': {'_id': 'hello'}}))
+
+    def test_shard_for_routing_overrides_id(self):
+        self.assertEqual(self.router.shard_for({'index': {'_id': 'hello'}}),
+                         self.router.shard_for({'index': {'_id': 'other', '_routing': 'hello'}}))
+
+    def test_group_actions(self):
+        actions = create_es_actions('baz', [{'id': 'doc_%d' % i} for i in range(0, 20)], TranslationMap(), False)
+        grouped = self.router.group_actions(actions)
+
+        self.assertEqual(20, sum(len(node_actions) for node_actions in grouped.values()))
+        for node, node_actions in grouped.items():
+            for action, _ in node_actions:
+                self.assertEqual(node, self.router.primary_nodes[self.router.shard_for(action)])
+
+    @raises(IllegalStateError)
+    def test_unassigned_primary(self):
+        state = {'metadata': self.cluster_state['metadata'], 'routing_table': {'indices': {'baz': {'shards': {
+            '0': [{'node': None, 'primary': True, 'state': 'UNASSIGNED'}]}}}}}
+        ShardRouter.from_cluster_state('baz', state, self.nodes_info, lambda host: host)
+
+
+class TestJsonFileSource(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, content, open_func=open):
+        path = os.path.join(self.dir.name, name)
+        with open_func(path, 'wt') as f:
+            f.write(content)
+        return path
+
+    def test_read_select_response(self):
+        path = self.write('export.json', dumps({'response': {'numFound': 2, 'docs': [{'id': '1'}, {'id': '2'}]}}))
+        self.assertEqual([{'id': '1'}, {'id': '2'}], list(JsonFileSource([path]).read_docs()))
+
+    def test_read_docs_array(self):
+        path = self.write('export.json', dumps([{'id': '1'}]))
+        self.assertEqual([{'id': '1'}], list(JsonFileSource([path]).read_docs()))
+
+    def test_read_json_lines(self):
+        path = self.write('export.jsonl', '{"id": "1"}\n\n{"id": "2"}\n')
+        self.assertEqual([{'id': '1'}, {'id': '2'}], list(JsonFileSource([path]).read_docs()))
+
+    def test_read_select_response_by_chunks(self):
+        docs = [{'id': str(i), 'title': 'doc %d' % i, 'count': 1000 * i} for i in range(0, 50)]
+        path = self.write('export.json', dumps({'responseHeader': {'status': 0}, 'response': {'numFound': 50, 'docs': docs},
+                                                'nextCursorMark': 'abc'}, indent=1))
+        with open(path, 'rb') as export:
+            self.assertEqual(docs, list(_read_json(export, chunk_size=16)))
+
+    @raises(ValueError)
+    def test_read_truncated_json(self):
+        path = self.write('export.json', '{"response": {"docs": [{"id": "1"},')
+        list(JsonFileSource([path]).read_docs())
+
+    def test_read_empty_json_lines(self):
+        path = self.write('export.jsonl', '')
+        self.assertEqual([], list(JsonFileSource([path]).read_docs()))
+
+    def test_read_gzipped_files(self):
+        lines = self.write('export.ndjson.gz', '{"id": "1"}\n', gzip.open)
+        array = self.write('export.json.gz', '[{"id": "2"}]', gzip.open)
+        self.assertEqual([{'id': '1'}, {'id': '2'}], list(JsonFileSource([lines, array]).read_docs()))
+
+    def test_produce_results_pages(self):
+        path = self.write('export.jsonl', ''.join('{"id": "%d"}\n' % i for i in range(0, 5)))
+        self.assertEqual([2, 2, 1], [len(page) for page in JsonFileSource([path]).produce_results(solr_rows_pagination=2)])
+
+    def test_from_patterns(self):
+        paths = [self.write(name, '') for name in ('b.jsonl', 'a.jsonl', 'c.json')]
+        self.assertEqual(sorted(paths[0:2]), JsonFileSource.from_patterns(os.path.join(self.dir.name, '*.jsonl')).paths)
+
+
+class TestBulkFileSink(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.dir.name, 'bulk')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_write_bulk_file(self):
+        sink = BulkFileSink(self.prefix)
+        sink.write(create_es_actions('baz', [{'id': '123', 'foo': 'bar'}], TranslationMap(), False))
+        sink.close()
+
+        with open(self.prefix + '-00000.ndjson') as f:
+            self.assertEqual([{'index': {'_index': 'baz', '_type': DEFAULT_ES_DOC_TYPE, '_id': '123'}}, {'id': '123', 'foo': 'bar'}],
+                             [loads(line) for line in f.read().splitlines()])
+
+    def test_write_size_capped_files(self):
+        actions = create_es_actions('baz', [{'id': '%03d' % i} for i in range(0, 10)], TranslationMap(), False)
+        pair_size = len(('%s\n%s\n' % (dumps(actions[0][0]), dumps(actions[0][1]))).encode('utf-8'))
+        sink = BulkFileSink(self.prefix, max_bytes=3 * pair_size)
+        sink.write(actions)
+        sink.close()
+
+        self.assertEqual(4, sink.nb_files)
+        self.assertEqual([6, 6, 6, 2], [len(open('%s-%05d.ndjson' % (self.prefix, i)).read().splitlines()) for i in range(0, 4)])
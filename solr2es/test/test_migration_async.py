@@ -1,8 +1,16 @@
+import asyncio
+import gzip
+import ssl
+from json import dumps
+
 import aiohttp
 import asynctest
+from elasticsearch.exceptions import ImproperlyConfigured
 from elasticsearch_async import AsyncElasticsearch
 
-from solr2es.__main__ import Solr2EsAsync
+from solr2es.__main__ import Solr2EsAsync, AsyncMemoryBudget, EsTarget, TranslationMap, StatsAIOHttpConnection, \
+    TransportStats
+from solr2es.test.test_migration import GzipBulkServer
 
 
 class TestMigrationAsync(asynctest.TestCase):
@@ -33,3 +41,162 @@ class TestMigrationAsync(asynctest.TestCase):
                              (await self.aes.indices.get_field_mapping(index=['foo'], fields=['my_field']))
                              ['foo']['mappings']['doc']['my_field']['mapping'])
 
+
+class TestAsyncMemoryBudget(asynctest.TestCase):
+    async def test_wait_blocks_until_release(self):
+        budget = AsyncMemoryBudget(5)
+        nb_bytes = budget.acquire([{'id': '123'}])
+        waiter = asyncio.ensure_future(budget.wait())
+
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        budget.release(nb_bytes)
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_wait_without_limit(self):
+        budget = AsyncMemoryBudget()
+        budget.acquire([{'id': 'x' * 1000}])
+        await asyncio.wait_for(budget.wait(), 1)
+
+    async def test_migrate_bounds_pending_bulks(self):
+        aes = FakeAsyncEs()
+        budget = AsyncMemoryBudget(1)
+        nb_results = await Solr2EsAsync(FakeSolrSession(100), aes, 'http://solr/core', memory_budget=budget).migrate(
+            'foo', solr_rows_pagination=10)
+
+        self.assertEqual(100, nb_results)
+        self.assertEqual(100, aes.nb_docs)
+        self.assertEqual(1, aes.max_pending)
+        self.assertEqual(0, budget.used)
+
+    async def test_migrate_awaits_bulks_without_limit(self):
+        aes = FakeAsyncEs()
+        budget = AsyncMemoryBudget()
+        await Solr2EsAsync(FakeSolrSession(100), aes, 'http://solr/core', memory_budget=budget).migrate(
+            'foo', solr_rows_pagination=10)
+
+        self.assertEqual(100, aes.nb_docs)
+        self.assertEqual(0, aes.pending)
+        self.assertEqual(0, budget.used)
+
+
+class TestMigrateToTargetsAsync(asynctest.TestCase):
+    async def test_migrate_to_two_targets(self):
+        blue, green = FakeAsyncEs(), FakeAsyncEs()
+        nb_results = await Solr2EsAsync(FakeSolrSession(25), None, 'http://solr/core').migrate_to_targets(
+            [EsTarget(blue, 'blue'), EsTarget(green, 'green', translation_map=TranslationMap({'id': {'name': 'ref'}}))],
+            solr_rows_pagination=10)
+
+        self.assertEqual([25, 25], nb_results)
+        self.assertEqual(['blue'] * 3, [index for index, _ in blue.bulks])
+        self.assertIn('"ref": "id_000"', green.bulks[0][1])
+
+    async def test_slow_target_buffers_at_most_buffer_size_pages(self):
+        session = FakeSolrSession(100)
+        slow = FakeAsyncEs(delay=0.02, session=session)
+        await Solr2EsAsync(session, None, 'http://solr/core').migrate_to_targets(
+            [EsTarget(FakeAsyncEs(), 'fast'), EsTarget(slow, 'slow')], solr_rows_pagination=10, buffer_size=2)
+
+        self.assertEqual(100, slow.nb_docs)
+        self.assertLessEqual(slow.max_pages_ahead, 2 + 2)
+
+    async def test_failed_target_is_drained(self):
+        ok, failing = FakeAsyncEs(), FakeAsyncEs(error=ValueError('bulk failed'))
+        budget = AsyncMemoryBudget()
+        with self.assertRaises(ValueError):
+            await Solr2EsAsync(FakeSolrSession(100), None, 'http://solr/core', memory_budget=budget).migrate_to_targets(
+                [EsTarget(ok, 'ok'), EsTarget(failing, 'failing')], solr_rows_pagination=10, buffer_size=1)
+
+        self.assertEqual(100, ok.nb_docs)
+        self.assertEqual(1, failing.nb_calls)
+        self.assertEqual(0, budget.used)
+
+
+class TestStatsAIOHttpConnection(asynctest.TestCase):
+    async def test_es_compressed_responses_are_counted(self):
+        stats = TransportStats()
+        with GzipBulkServer() as server:
+            connection = StatsAIOHttpConnection(port=server.server_address[1], http_compress=True, transport_stats=stats)
+            status, _, data = await connection.perform_request('POST', '/_bulk', body=b'{"index": {}}\n{}\n')
+            await connection.close()
+
+        self.assertEqual((200, GzipBulkServer.BODY), (status, data.encode()))
+        self.assertEqual(len(GzipBulkServer.BODY), stats.received_logical)
+        self.assertEqual(len(gzip.compress(GzipBulkServer.BODY)), stats.received_wire)
+
+    async def test_ssl_options(self):
+        unverified = StatsAIOHttpConnection(use_ssl=True, use_dns_cache=False)
+        verified = StatsAIOHttpConnection(use_ssl=True, verify_certs=True)
+
+        self.assertEqual(ssl.CERT_NONE, unverified.session.connector._ssl.verify_mode)
+        self.assertFalse(unverified.session.connector.use_dns_cache)
+        self.assertEqual(ssl.CERT_REQUIRED, verified.session.connector._ssl.verify_mode)
+        self.assertTrue(verified.session.connector._ssl.check_hostname)
+        await unverified.close()
+        await verified.close()
+
+    async def test_ssl_context_with_ssl_options(self):
+        with self.assertRaises(ImproperlyConfigured):
+            StatsAIOHttpConnection(ssl_context=ssl.create_default_context(), verify_certs=True)
+
+
+class FakeSolrSession(object):
+    """aiohttp session answering the solr cursor queries with nb_docs docs"""
+    class Response(object):
+        def __init__(self, body) -> None:
+            self.body = body
+            self.headers = {}
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def read(self):
+            return self.body
+
+    def __init__(self, nb_docs) -> None:
+        self.ids = ['id_%03d' % i for i in range(0, nb_docs)]
+        self.nb_pages = 0
+
+    def get(self, url, params):
+        self.nb_pages += 1
+        position = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+        page = self.ids[position:position + params['rows']]
+        return FakeSolrSession.Response(dumps({
+            'response': {'numFound': len(self.ids), 'docs': [{'id': i} for i in page]},
+            'nextCursorMark': str(position + len(page)) if page else params['cursorMark']}).encode('utf-8'))
+
+
+class FakeAsyncEs(object):
+    """AsyncElasticsearch counting its pending bulks and how many solr pages were read ahead of them"""
+    class Indices(object):
+        async def exists(self, index):
+            return True
+
+    def __init__(self, delay=0.01, session=None, error=None) -> None:
+        self.indices = FakeAsyncEs.Indices()
+        self.delay = delay
+        self.session = session
+        self.error = error
+        self.nb_calls = 0
+        self.max_pages_ahead = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.nb_docs = 0
+        self.bulks = []
+
+    async def bulk(self, body, index, doc_type=None, refresh=False):
+        self.nb_calls += 1
+        if self.error is not None:
+            raise self.error
+        if self.session is not None:
+            self.max_pages_ahead = max(self.max_pages_ahead, self.session.nb_pages - len(self.bulks))
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        await asyncio.sleep(self.delay)
+        self.pending -= 1
+        self.nb_docs += len(body.splitlines()) // 2
+        self.bulks.append((index, body))
+        return {'errors': False, 'items': []}